@@ -0,0 +1,487 @@
+"""
+Offline Veracross and Lightspeed backends for benchmarks.
+
+The fakes stand in for the requests sessions of veracross_api.Veracross and
+lightspeed_api.Lightspeed, so everything above the HTTP layer (paging, rate limiting, retries,
+JSON decoding, our own loops) runs exactly as it does against the real APIs. Data is synthetic
+and generated from a seed, so two runs at the same scale see the same tenant.
+"""
+import bisect
+import datetime
+import json
+import random
+import threading
+import time
+from urllib import parse
+
+LS_API_URL = "https://api.lightspeedapp.com/API/V3/Account/1/"
+VC_API_URL = "https://vc.invalid/api/"
+
+# Config accepted by main.py for the fake tenant.
+CONFIG = {
+    "vcuser": "benchmark",
+    "vcpass": "benchmark",
+    "vcurl": VC_API_URL,
+    "account_id": "1",
+    "refresh_token": "benchmark",
+    "client_secret": "benchmark",
+    "client_id": "benchmark",
+    "import_options_creditamount": "10000",
+    "import_options_lastsync": "Last Sync",
+    "import_options_veracrossid": "VeracrossID",
+}
+
+CUSTOMER_TYPES = [dict(customerTypeID="1", name="Student"), dict(customerTypeID="2", name="FacultyStaff")]
+CUSTOM_FIELDS = [dict(customFieldID="1", name="VeracrossID"), dict(customFieldID="2", name="Last Sync")]
+SHOPS = [dict(shopID="1", name="Bookstore", timeZone="US/Eastern"),
+         dict(shopID="2", name="Cafe", timeZone="Asia/Tokyo")]
+EMPLOYEES = [dict(employeeID="1", firstName="John", lastName="Smith")]
+PAYMENT_TYPES = [dict(paymentTypeID="1", name="Charge Account", code="SCA"),
+                 dict(paymentTypeID="2", name="Cash", code="CASH")]
+
+
+def utc_time(stamp):
+    """
+    :param stamp: Timestamp with a UTC offset, e.g. 2023-09-01T08:00:00-04:00
+    :return: The same instant as a sortable UTC string
+    """
+    moment = datetime.datetime.fromisoformat(stamp)
+    return moment.astimezone(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+
+
+class FakeResponse(object):
+    """
+    The parts of requests.Response the API clients use.
+    """
+
+    def __init__(self, status_code, payload=None, headers=None):
+        self.status_code = status_code
+        self.content = json.dumps(payload if payload is not None else {}).encode("utf-8")
+        self.headers = headers or dict()
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class FakeSession(object):
+    """
+    Base for the fake sessions: simulated latency and the session attributes the clients touch.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.headers = dict()
+        self.auth = None
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def mount(self, prefix, adapter):
+        pass
+
+    def wait(self):
+        with self.lock:
+            self.requests += 1
+        if self.latency:
+            # Jitter so concurrent workers don't move in lockstep.
+            time.sleep(random.uniform(self.latency * 0.5, self.latency * 1.5))
+
+
+class FakeLightspeedSession(FakeSession):
+    """
+    Lightspeed Retail V3 Customer, Sale and reference endpoints with a leaky bucket rate limit.
+    GETs cost 1 unit and writes 10. A request that overflows the bucket gets a 429.
+    """
+
+    def __init__(self, people, sales, students, latency=0.0, bucket_size=60, drip_rate=0.0, seed=1):
+        """
+        :param people: Veracross people, from fake_people()
+        :param sales: Number of Sales to generate
+        :param students: person_pk of people who are students
+        :param latency: Average seconds per request
+        :param bucket_size: Leaky bucket size in units
+        :param drip_rate: Units drained per second. 0 disables the rate limit.
+        :param seed: Random seed for the data
+        """
+        FakeSession.__init__(self, latency)
+        self.bucket_size = bucket_size
+        self.drip_rate = drip_rate
+        self.bucket_level = 0.0
+        self.bucket_time = time.monotonic()
+        self.throttled = 0
+        self.version = 0
+        self.customer_lists = dict()
+        self.sale_lists = dict()
+        self.next_id = 1
+        self.customers = dict()
+        self.by_person = dict()
+        self.sales = []
+        self.sale_times = []
+        self.sales_by_id = dict()
+        self.generate(people, sales, students, random.Random(seed))
+
+    def new_id(self):
+        with self.lock:
+            self.next_id += 1
+            return str(self.next_id)
+
+    def generate(self, people, sales, students, rnd):
+        """
+        Most people already exist in Lightspeed, some with stale details, some not yet at all.
+        """
+        for p, h in people:
+            roll = rnd.random()
+            if roll < 0.05:
+                continue
+            customer_id = self.new_id()
+            email = p["email_1"] if roll > 0.15 else "old." + p["email_1"]
+            self.customers[customer_id] = dict(
+                customerID=customer_id, creditAccountID=customer_id, firstName=p["first_nick_name"],
+                lastName=p["last_name"], companyRegistrationNumber=str(p["person_pk"]),
+                customerTypeID="1" if p["person_pk"] in students else "2",
+                Contact=dict(custom=str(p["person_pk"]),
+                             Emails=dict(ContactEmail=dict(address=email, useType="Primary")),
+                             Addresses=dict(ContactAddress=dict(address1=h["address_1"], address2=h["address_2"] or "",
+                                                                city=h["city"], zip=h["postal_code"],
+                                                                state=h["state_province"]))),
+                CreditAccount=dict(creditAccountID=customer_id, balance="0.00", creditLimit="10000.00"))
+            self.by_person[str(p["person_pk"])] = customer_id
+
+        customer_ids = list(self.customers)
+        begin = datetime.datetime(2023, 9, 1, 8)
+        for n in range(sales):
+            customer = self.customers[rnd.choice(customer_ids)]
+            stamp = (begin + datetime.timedelta(minutes=int(n * 250000 / max(sales, 1)))).strftime(
+                "%Y-%m-%dT%H:%M:%S-04:00")
+            shop_id = "1" if rnd.random() < 0.8 else "2"
+            lines = []
+            for k in range(rnd.choice((1, 1, 1, 2, 3, 5))):
+                quantity = rnd.choice((1, 1, 2, 3))
+                price = rnd.choice(("1.25", "2.50", "4.99", "12.00", "35.75"))
+                subtotal = float(price) * quantity
+                lines.append(dict(saleLineID=str(n * 10 + k), shopID=shop_id, timeStamp=stamp,
+                                  unitQuantity=str(quantity), unitPrice=price, calcLineDiscount="0",
+                                  displayableSubtotal="%.2f" % subtotal, calcTax1="%.5f" % (subtotal * 0.0475),
+                                  calcTotal="%.5f" % (subtotal * 1.0475),
+                                  Item=dict(description="Item %d" % rnd.randint(1, 500))))
+            on_account = rnd.random() < 0.7
+            if on_account:
+                balance = float(customer["CreditAccount"]["balance"]) + sum(float(s["calcTotal"]) for s in lines)
+                customer["CreditAccount"]["balance"] = "%.2f" % balance
+            sale = dict(saleID=str(n + 1), timeStamp=stamp, completed="true", shopID=shop_id,
+                        customerID=customer["customerID"],
+                        Customer={k: customer[k] for k in ("customerID", "firstName", "lastName",
+                                                           "companyRegistrationNumber", "customerTypeID")},
+                        SaleLines=dict(SaleLine=lines if len(lines) > 1 else lines[0]),
+                        SalePayments=dict(SalePayment=dict(amount="%.2f" % sum(float(s["calcTotal"]) for s in lines),
+                                                           PaymentType=PAYMENT_TYPES[0 if on_account else 1])))
+            self.sales.append(sale)
+            self.sale_times.append(utc_time(stamp))
+            self.sales_by_id[sale["saleID"]] = sale
+
+    def headers_for(self):
+        return {"X-LS-API-Bucket-Level": "{:.0f}/{}".format(self.bucket_level, self.bucket_size),
+                "X-LS-API-Drip-Rate": str(self.drip_rate or 1000000)}
+
+    def admit(self, units):
+        """
+        Add a request to the bucket.
+        :return: True if it fits
+        """
+        if not self.drip_rate:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.bucket_level = max(0.0, self.bucket_level - (now - self.bucket_time) * self.drip_rate)
+            self.bucket_time = now
+            if self.bucket_level + units > self.bucket_size:
+                self.throttled += 1
+                return False
+            self.bucket_level += units
+            return True
+
+    def page(self, key, items, query, url):
+        limit = int(query.get("limit", 100))
+        offset = int(query.get("offset", 0))
+        body = {"@attributes": {"count": str(len(items)), "offset": str(offset), "limit": str(limit),
+                                "next": "", "previous": ""}}
+        if offset + limit < len(items):
+            next_query = dict(query, offset=offset + limit)
+            body["@attributes"]["next"] = url.split("?")[0] + "?" + parse.urlencode(next_query, safe=":-[],")
+        chunk = items[offset:offset + limit]
+        if chunk:
+            body[key] = chunk if len(chunk) > 1 else chunk[0]
+        return FakeResponse(200, body, self.headers_for())
+
+    @staticmethod
+    def relations(record, load_relations, names):
+        # Drop relations that were not asked for.
+        if load_relations == "all":
+            return record
+        return {k: v for k, v in record.items() if k not in names or k in load_relations}
+
+    def customer_list(self, query):
+        # Filtered lists are cached until the next write so paging stays cheap at scale.
+        filters = tuple((k, query[k]) for k in ("customerTypeID", "companyRegistrationNumber", "customerID")
+                        if k in query)
+        key = (filters, query.get("load_relations", ""), self.version)
+        if key not in self.customer_lists:
+            if "companyRegistrationNumber" in query:
+                customer_id = self.by_person.get(query["companyRegistrationNumber"])
+                items = [self.customers[customer_id]] if customer_id in self.customers else []
+            elif "customerID" in query:
+                items = [self.customers[query["customerID"]]] if query["customerID"] in self.customers else []
+            else:
+                items = list(self.customers.values())
+            if "customerTypeID" in query:
+                items = [c for c in items if c["customerTypeID"] == query["customerTypeID"]]
+            items = [self.relations(c, query.get("load_relations", ""), ("Contact", "CreditAccount"))
+                     for c in items]
+            self.customer_lists = {key: items}
+        return self.customer_lists[key]
+
+    def sale_list(self, query):
+        if "saleID" in query and query["saleID"].startswith("IN,"):
+            items = [self.sales_by_id[i] for i in query["saleID"][4:-1].split(",") if i in self.sales_by_id]
+            return [self.relations(s, query.get("load_relations", ""), ("Customer", "SaleLines", "SalePayments"))
+                    for s in items]
+
+        # Date range lists are cached while they are paged through.
+        key = tuple(sorted((k, v) for k, v in query.items() if k not in ("offset", "limit")))
+        if key not in self.sale_lists:
+            if len(self.sale_lists) > 32:
+                self.sale_lists.clear()
+            if "timeStamp" in query:
+                operator, begin, end = query["timeStamp"].split(",")
+                items = self.sales[bisect.bisect_left(self.sale_times, utc_time(begin)):
+                                   bisect.bisect_right(self.sale_times, utc_time(end))]
+            else:
+                items = self.sales
+            if "shopID" in query:
+                items = [s for s in items if s["shopID"] == str(query["shopID"])]
+            items = [self.relations(s, query.get("load_relations", ""), ("Customer", "SaleLines", "SalePayments"))
+                     for s in items]
+            self.sale_lists[key] = items
+        return self.sale_lists[key]
+
+    def dispatch(self, method, url, data=None):
+        self.wait()
+        if not self.admit(1 if method == "get" else 10):
+            return FakeResponse(429, dict(message="Rate limit exceeded"), dict(self.headers_for(), **{"Retry-After": "1"}))
+
+        path, _, query = url.partition("?")
+        source = path[len(LS_API_URL):-len(".json")]
+        query = dict(parse.parse_qsl(query))
+        parts = source.split("/")
+
+        if method == "get":
+            if source == "Customer":
+                return self.page("Customer", self.customer_list(query), query, url)
+            if parts[0] == "Customer" and len(parts) == 2 and parts[1] in self.customers:
+                return FakeResponse(200, dict(Customer=self.customers[parts[1]]), self.headers_for())
+            if source == "Sale":
+                return self.page("Sale", self.sale_list(query), query, url)
+            for name, items in (("Customer/CustomField", CUSTOM_FIELDS), ("CustomerType", CUSTOMER_TYPES),
+                                ("Shop", SHOPS), ("Employee", EMPLOYEES), ("PaymentType", PAYMENT_TYPES)):
+                if source == name:
+                    return self.page(name.split("/")[-1], items, query, url)
+            return FakeResponse(404, dict(message="Not found"), self.headers_for())
+
+        body = json.loads(data) if data else dict()
+        with self.lock:
+            self.version += 1
+            if method == "post" and source == "Customer":
+                customer_id = str(self.next_id + 1)
+                self.next_id += 1
+                credit_limit = body.get("CreditAccount", dict()).get("creditLimit", "0.00")
+                customer = dict(body, customerID=customer_id, creditAccountID=customer_id,
+                                CreditAccount=dict(creditAccountID=customer_id, balance="0.00", creditLimit=credit_limit))
+                self.customers[customer_id] = customer
+                self.by_person[str(customer.get("companyRegistrationNumber"))] = customer_id
+                return FakeResponse(200, dict(Customer=customer), self.headers_for())
+            if method == "put" and parts[0] == "Customer" and parts[-1] in self.customers:
+                # Only the limit of a credit account can be set.
+                if "CreditAccount" in body:
+                    body["CreditAccount"] = {k: v for k, v in body["CreditAccount"].items() if k == "creditLimit"}
+                merge(self.customers[parts[-1]], body)
+                return FakeResponse(200, dict(Customer=self.customers[parts[-1]]), self.headers_for())
+            if method == "delete" and parts[0] == "Customer" and parts[-1] in self.customers:
+                customer = self.customers.pop(parts[-1])
+                self.by_person.pop(str(customer.get("companyRegistrationNumber")), None)
+                return FakeResponse(200, dict(Customer=customer), self.headers_for())
+            if method == "post" and source == "Sale":
+                # Balance clearing sale. Pays the account down to zero.
+                customer = self.customers.get(str(body.get("customerID")))
+                if customer:
+                    customer["CreditAccount"]["balance"] = "0.00"
+                sale_id = str(len(self.sales_by_id) + 1)
+                self.sales_by_id[sale_id] = dict(body, saleID=sale_id)
+                return FakeResponse(200, dict(Sale=self.sales_by_id[sale_id]), self.headers_for())
+        return FakeResponse(404, dict(message="Not found"), self.headers_for())
+
+    def get(self, url, **kwargs):
+        return self.dispatch("get", url)
+
+    def post(self, url, data=None, **kwargs):
+        return self.dispatch("post", url, data)
+
+    def put(self, url, data=None, **kwargs):
+        return self.dispatch("put", url, data)
+
+    def delete(self, url, **kwargs):
+        return self.dispatch("delete", url)
+
+
+def merge(record, changes):
+    """
+    Apply a PUT body the way Lightspeed does: nested objects are updated, not replaced.
+    """
+    for key, value in changes.items():
+        if isinstance(value, dict) and isinstance(record.get(key), dict):
+            merge(record[key], value)
+        else:
+            record[key] = value
+
+
+class FakeVeracrossSession(FakeSession):
+    """
+    Veracross v2 students, facstaff and households, 100 records a page, with a request quota
+    per window reported in X-Rate-Limit-Remaining/X-Rate-Limit-Reset.
+    """
+
+    def __init__(self, people, students, latency=0.0, rate_limit=0, rate_window=300):
+        """
+        :param people: Veracross people, from fake_people()
+        :param students: person_pk of people who are students
+        :param latency: Average seconds per request
+        :param rate_limit: Requests allowed per window. 0 disables the rate limit.
+        :param rate_window: Window length in seconds
+        """
+        FakeSession.__init__(self, latency)
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.window_start = time.monotonic()
+        self.window_requests = 0
+        self.students = [p for p, h in people if p["person_pk"] in students]
+        self.facstaff = [p for p, h in people if p["person_pk"] not in students]
+        self.households = dict()
+        for p, h in people:
+            self.households[h["household_pk"]] = h
+        self.household_list = list(self.households.values())
+
+    def headers_for(self):
+        if not self.rate_limit:
+            return {"X-Rate-Limit-Remaining": "300", "X-Rate-Limit-Reset": "0"}
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= self.rate_window:
+                self.window_start = now
+                self.window_requests = 0
+            self.window_requests += 1
+            remaining = max(1, self.rate_limit - self.window_requests)
+            reset = int(self.rate_window - (now - self.window_start))
+        return {"X-Rate-Limit-Remaining": str(remaining), "X-Rate-Limit-Reset": str(reset)}
+
+    def get(self, url, **kwargs):
+        self.wait()
+        path, _, query = url.partition("?")
+        source = path[len(VC_API_URL):-len(".json")]
+        # The client appends ?page= even to urls that already have a query.
+        query = dict(parse.parse_qsl(query.replace("?", "&")))
+        headers = self.headers_for()
+
+        if source.startswith("households/"):
+            household = self.households.get(int(source.split("/")[1]))
+            if household is None:
+                return FakeResponse(404, dict(message="Not found"), headers)
+            return FakeResponse(200, dict(household=household), headers)
+
+        if source == "students":
+            items = self.students
+            if "grade_level" in query:
+                grades = query["grade_level"].split(",")
+                items = [p for p in items if str(p["grade_level"]) in grades]
+        elif source == "facstaff":
+            items = self.facstaff
+        elif source == "households":
+            items = self.household_list
+        else:
+            return FakeResponse(404, dict(message="Not found"), headers)
+
+        if "updated_after" in query:
+            items = [p for p in items if p.get("update_date", "") > query["updated_after"]]
+
+        page = int(query.get("page", 1))
+        headers["X-Total-Count"] = str(len(items))
+        return FakeResponse(200, items[(page - 1) * 100:page * 100], headers)
+
+
+def fake_people(count, seed=1):
+    """
+    Synthetic Veracross people, two or three to a household.
+    :param count: Number of people
+    :param seed: Random seed
+    :return: list of (person, household)
+    """
+    rnd = random.Random(seed)
+    people = []
+    household = None
+    for n in range(count):
+        if household is None or rnd.random() < 0.4:
+            household_pk = 500000 + n
+            household = dict(household_pk=household_pk, address_1="%d Main Street" % rnd.randint(1, 9999),
+                             address_2=None if rnd.random() < 0.8 else "Apt %d" % rnd.randint(1, 99),
+                             city=rnd.choice(("Durham", "Raleigh", "Chapel Hill", "Cary")), state_province="NC",
+                             postal_code="27%03d" % rnd.randint(0, 999), country="US")
+        person = dict(person_pk=100000 + n, first_nick_name="First%d" % n, last_name="Last%d" % n,
+                      email_1="person%d@example.org" % n, household_fk=household["household_pk"],
+                      grade_level=rnd.randint(1, 12),
+                      update_date="2023-%02d-%02d" % (rnd.randint(1, 12), rnd.randint(1, 28)))
+        people.append((person, household))
+    return people
+
+
+def install(people=1000, sales=10000, latency=0.0, ls_bucket_size=60, ls_drip_rate=0.0,
+            vc_rate_limit=0, vc_rate_window=300, student_share=0.7, seed=1):
+    """
+    Point lightspeed_api.Lightspeed and veracross_api.Veracross at fresh fake backends.
+    Call before main.py creates its connections.
+    :return: (FakeLightspeedSession, FakeVeracrossSession)
+    """
+    import lightspeed_api
+    import veracross_api
+
+    vc_people = fake_people(people, seed)
+    rnd = random.Random(seed + 1)
+    students = set(p["person_pk"] for p, h in vc_people if rnd.random() < student_share)
+
+    ls_session = FakeLightspeedSession(vc_people, sales, students, latency, ls_bucket_size, ls_drip_rate, seed)
+    vc_session = FakeVeracrossSession(vc_people, students, latency, vc_rate_limit, vc_rate_window)
+
+    real_lightspeed = getattr(lightspeed_api.Lightspeed, "real_class", lightspeed_api.Lightspeed)
+    real_veracross = getattr(veracross_api.Veracross, "real_class", veracross_api.Veracross)
+
+    class Lightspeed(real_lightspeed):
+        real_class = real_lightspeed
+
+        def __init__(self, config):
+            real_lightspeed.__init__(self, config)
+            self.api_url = LS_API_URL
+            self.session = ls_session
+            self.bearer_token = "benchmark"
+            self.token_expire_time = datetime.datetime.now() + datetime.timedelta(days=1)
+
+    class Veracross(real_veracross):
+        real_class = real_veracross
+
+        def __init__(self, config):
+            real_veracross.__init__(self, config)
+            self.api_url = VC_API_URL
+            self.session = vc_session
+
+    lightspeed_api.Lightspeed = Lightspeed
+    veracross_api.Veracross = Veracross
+    return ls_session, vc_session
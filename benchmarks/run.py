@@ -0,0 +1,215 @@
+"""
+End to end sync and export benchmark against the offline backends in fakes.py.
+
+Drives sync_ls_vc and export_charge_balance from main.py exactly as a cron run would, with no
+network, and reports wall time, throughput, API calls and memory for each scenario.
+
+    python benchmarks/run.py --people=5000 --sales=100000 --latency=0.05
+    python benchmarks/run.py --scenario=sync --people=1000 --ls_drip_rate=1 --latency=0.2
+
+Options:
+    --scenario = sync, export, shards or all (default all)
+                 shards exports the Cafe (UTC+09:00) whole and by day, and fails unless both have the same lines
+    --people = Veracross people (default 1000)
+    --sales = Lightspeed Sales (default 10000)
+    --latency = Average seconds per API request (default 0)
+    --ls_drip_rate = Lightspeed leaky bucket drip rate in units/second, 1 is the real limit (default 0, unlimited)
+    --ls_bucket_size = Lightspeed leaky bucket size (default 60)
+    --vc_rate_limit = Veracross requests per 5 minute window (default 0, unlimited)
+    --operation_json = Extra options for every job as JSON, e.g. '{"sync_prefetch": true}'
+    --memory = Trace Python allocations for peak memory. Slows the run down.
+    --json_path = Write the results as JSON
+    --verbose = Keep the connector's log output
+"""
+import csv
+import getopt
+import glob
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import context  # noqa: E402
+import fakes  # noqa: E402
+import main  # noqa: E402
+
+
+def sync_jobs(workdir, extra):
+    jobs = []
+    for name, sync_type in (("sync students", "Students"), ("sync faculty staff", "Faculty Staff")):
+        operation_json = dict(type=sync_type, sync_force=False, sync_delete_missing=False,
+                              sync_filters=dict(after_date="", grade_level=""),
+                              state_path=os.path.join(workdir, "state.db"))
+        operation_json.update(extra)
+        jobs.append((name, main.sync_ls_vc, operation_json))
+    return jobs
+
+
+def export_jobs(workdir, extra):
+    operation_json = dict(type="Student", export_shop="Bookstore", export_path=workdir,
+                          export_date_begin="2023-09-01", export_date_end="2024-03-01",
+                          export_clear_charges=False,
+                          export_options_transaction_source=2, export_options_transaction_type=1,
+                          export_options_school_year=2023, export_options_catalog_item=22,
+                          state_path=os.path.join(workdir, "state.db"))
+    operation_json.update(extra)
+    return [("export students", main.export_charge_balance, operation_json)]
+
+
+def shard_jobs(workdir, extra):
+    jobs = []
+    for name, shard in (("export cafe", None), ("export cafe by day", "day")):
+        export_path = os.path.join(workdir, name.replace(" ", "_"))
+        os.makedirs(export_path)
+        name, operation, operation_json = export_jobs(workdir, extra)[0]
+        operation_json.update(export_shop="Cafe", export_path=export_path)
+        if shard:
+            operation_json["export_shard"] = shard
+        jobs.append((os.path.basename(export_path).replace("_", " "), operation, operation_json))
+    return jobs
+
+
+def export_lines(export_path):
+    """
+    :return: sorted rows of the saleline export in export_path
+    """
+    rows = []
+    for filename in glob.glob(os.path.join(export_path, "lightspeed_salelines_export_*.csv")):
+        with open(filename, newline="") as f:
+            rows.extend(tuple(row) for row in list(csv.reader(f))[1:])
+    return sorted(rows)
+
+
+def compare_shards(jobs):
+    """
+    Check the sharded Cafe export has exactly the lines of the unsharded one.
+    :return: 0 when they match, otherwise 1
+    """
+    whole, sharded = [export_lines(operation_json["export_path"]) for name, operation, operation_json in jobs]
+    if whole == sharded:
+        print("Sharded export matches: {} lines.".format(len(whole)))
+        return 0
+    print("Sharded export differs: {} lines whole, {} by day, {} missing, {} extra.".format(
+        len(whole), len(sharded), len(set(whole) - set(sharded)), len(set(sharded) - set(whole))))
+    return 1
+
+
+def run_job(name, operation, operation_json, trace_memory):
+    """
+    Run one job on a fresh context.
+    :return: dict of results
+    """
+    ctx = context.RunContext(fakes.CONFIG)
+    if trace_memory:
+        tracemalloc.start()
+
+    status = 0
+    started = time.perf_counter()
+    try:
+        operation(fakes.CONFIG, operation_json, ctx)
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 2
+    seconds = time.perf_counter() - started
+
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    summary = ctx.metrics.summary()
+    records = sum(n for key, n in summary["records"].items()
+                  if key.endswith(".processed") or key.endswith(".sale_lines"))
+    return dict(name=name, status=status, seconds=round(seconds, 3),
+                records=records,
+                records_per_second=round(records / seconds, 1) if seconds else None,
+                api_calls={service: sum(c["calls"] for c in summary["api"] if c["service"] == service)
+                           for service in ("lightspeed", "veracross")},
+                api_bytes=sum(c["bytes"] for c in summary["api"]),
+                retries=sum(c["retries"] for c in summary["api"]),
+                rate_limit_sleep_seconds=summary["rate_limit_sleep_seconds"],
+                peak_traced_bytes=peak,
+                metrics=summary)
+
+
+def main_benchmark(argv):
+    scenario = "all"
+    scale = dict(people=1000, sales=10000, latency=0.0, ls_drip_rate=0.0, ls_bucket_size=60, vc_rate_limit=0)
+    extra = dict()
+    trace_memory = False
+    json_path = None
+    verbose = False
+
+    opts, args = getopt.getopt(argv, "", ["scenario=", "people=", "sales=", "latency=", "ls_drip_rate=",
+                                          "ls_bucket_size=", "vc_rate_limit=", "operation_json=", "memory",
+                                          "json_path=", "verbose"])
+    for opt, arg in opts:
+        if opt == "--scenario":
+            scenario = arg
+        elif opt in ("--people", "--sales", "--ls_bucket_size", "--vc_rate_limit"):
+            scale[opt[2:]] = int(arg)
+        elif opt in ("--latency", "--ls_drip_rate"):
+            scale[opt[2:]] = float(arg)
+        elif opt == "--operation_json":
+            extra = json.loads(arg)
+        elif opt == "--memory":
+            trace_memory = True
+        elif opt == "--json_path":
+            json_path = arg
+        elif opt == "--verbose":
+            verbose = True
+
+    if not verbose:
+        main.applogs.setLevel(logging.WARNING)
+
+    started = time.perf_counter()
+    ls_session, vc_session = fakes.install(**scale)
+    print("Generated {people} people and {sales} sales in {:.1f}s.".format(time.perf_counter() - started,
+                                                                         **scale))
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        jobs = []
+        if scenario in ("sync", "all"):
+            jobs += sync_jobs(workdir, extra)
+        if scenario in ("export", "all"):
+            jobs += export_jobs(workdir, extra)
+        if scenario in ("shards", "all"):
+            jobs += shard_jobs(workdir, extra)
+
+        for name, operation, operation_json in jobs:
+            result = run_job(name, operation, operation_json, trace_memory)
+            results.append(result)
+            print("{name}: status {status}, {seconds:.2f}s, {records} records ({records_per_second}/s), "
+                  "{ls} Lightspeed and {vc} Veracross calls, {mb:.1f} MB received, {retries} retries".format(
+                      ls=result["api_calls"]["lightspeed"], vc=result["api_calls"]["veracross"],
+                      mb=result["api_bytes"] / 1048576.0, **result))
+            if result["peak_traced_bytes"] is not None:
+                print("    peak traced memory {:.1f} MB".format(result["peak_traced_bytes"] / 1048576.0))
+
+        if scenario in ("shards", "all"):
+            results.append(dict(name="compare shards", status=compare_shards(
+                [job for job in jobs if job[0].startswith("export cafe")])))
+
+    # ru_maxrss is KB on Linux.
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("Max RSS {:.1f} MB including the fake backends. Lightspeed throttled {} requests.".format(
+        max_rss / 1024.0, ls_session.throttled))
+
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(dict(scale=scale, operation_json=extra, max_rss_kb=max_rss,
+                           lightspeed_throttled=ls_session.throttled, results=results), f, indent=2)
+
+    if any(r["status"] for r in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main_benchmark(sys.argv[1:])
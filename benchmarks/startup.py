@@ -0,0 +1,115 @@
+"""
+Startup time benchmark for main.py.
+
+Runs "main.py --version" and "main.py --help" under python -X importtime and reports the wall
+clock time, the time spent importing our own modules and the slowest imports. Fails when a
+heavy module is imported just to print the version or help, or when startup is slower than
+--max_ms, so regressions show up before they reach the cron jobs.
+
+    python benchmarks/startup.py --runs=5 --max_ms=300
+"""
+import getopt
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must only load when an operation runs.
+HEAVY_MODULES = ("pandas", "numpy", "pytz", "requests", "lightspeed_api", "veracross_api")
+
+# Our own modules: every top level .py file of the repo.
+OWN_MODULES = tuple(sorted(f[:-len(".py")] for f in os.listdir(ROOT) if f.endswith(".py")))
+
+
+def parse_importtime(stderr):
+    """
+    Parse python -X importtime output.
+    :param stderr: stderr of the process
+    :return: list of (module, self microseconds, cumulative microseconds, nesting depth) in output order
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return imports
+
+
+def imported_by(imports, n):
+    """
+    Find which of our modules a module was imported through. importtime lists a module's imports
+    before the module itself, so its importer is the next line less deeply nested.
+    :param imports: list from parse_importtime
+    :param n: Index of the module in imports
+    :return: Name of our module or None
+    """
+    depth = imports[n][3]
+    for name, self_us, cumulative_us, parent_depth in imports[n + 1:]:
+        if parent_depth < depth:
+            if name.split(".")[0] in OWN_MODULES:
+                return name
+            depth = parent_depth
+    return None
+
+
+def measure(args):
+    """
+    Run main.py once with import timing.
+    :param args: main.py arguments
+    :return: (wall clock seconds, imports)
+    """
+    start = time.perf_counter()
+    r = subprocess.run([sys.executable, "-X", "importtime", os.path.join(ROOT, "main.py")] + args,
+                       cwd=ROOT, capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    return wall, parse_importtime(r.stderr)
+
+
+def main(argv):
+    runs = 5
+    max_ms = None
+
+    opts, args = getopt.getopt(argv, "", ["runs=", "max_ms="])
+    for opt, arg in opts:
+        if opt == "--runs":
+            runs = int(arg)
+        elif opt == "--max_ms":
+            max_ms = float(arg)
+
+    failed = False
+    for args in (["--version"], ["--help"]):
+        walls = []
+        imports = []
+        for _ in range(runs):
+            wall, imports = measure(args)
+            walls.append(wall)
+
+        best_ms = min(walls) * 1000
+        own_us = sum(i[1] for i in imports if i[0].split(".")[0] in OWN_MODULES)
+        print("main.py {}: best {:.0f} ms of {} runs, {} modules imported, {:.1f} ms in our modules".format(
+            " ".join(args), best_ms, runs, len(imports), own_us / 1000.0))
+
+        for name, self_us, cumulative_us, depth in sorted(imports, key=lambda i: i[2], reverse=True)[:5]:
+            print("    {:>8.1f} ms  {}".format(cumulative_us / 1000.0, name))
+
+        heavy = sorted(set("{} (imported by {})".format(i[0], imported_by(imports, n) or "python")
+                           for n, i in enumerate(imports)
+                           if i[0] in HEAVY_MODULES))
+        if heavy:
+            print("FAIL: heavy modules imported: " + ", ".join(heavy))
+            failed = True
+
+        if max_ms is not None and best_ms > max_ms:
+            print("FAIL: startup {:.0f} ms is over {:.0f} ms".format(best_ms, max_ms))
+            failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
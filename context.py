@@ -0,0 +1,249 @@
+"""
+Connections and reference tables shared by every phase of a run.
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import lsclient
+import metrics
+import vcclient
+
+applogs = logging.getLogger("lsvcconnector")
+
+# Connections kept open per host. Enough for every worker thread to hold one.
+POOL_SIZE = 16
+
+
+class RunContext(object):
+    """
+    Owns one Lightspeed and one Veracross client for the whole run, so the OAuth token is
+    refreshed once and HTTP connections are pooled, plus a TTL cache of Lightspeed reference
+    tables (customer types, custom fields, shops, employees, payment types).
+    The cache is optionally saved to disk so the next run can skip fetching them again.
+    A long running process can also keep the prefetched customer index of each customer type.
+    Every API call made through either connection is recorded in metrics.
+    """
+
+    def __init__(self, config, cache_path=None, cache_ttl=3600, keep_indexes=False, timeout=60):
+        """
+        :param config: config dictionary
+        :param cache_path: Optional complete path to a JSON file to keep reference tables between runs
+        :param cache_ttl: Seconds a cached reference table stays valid
+        :param keep_indexes: Keep customer indexes in memory for cache_ttl, for a long running process
+        :param timeout: Seconds each API request may wait on the connection
+        """
+        self.config = config
+        self.cache_path = cache_path
+        self.cache_ttl = cache_ttl
+        self.keep_indexes = keep_indexes
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self._ls = None
+        self._vc = None
+        self.references = dict()
+        self.loaders = dict()
+        self.indexes = dict()
+        self.written = dict()
+        self.metrics = metrics.Metrics()
+        self.load_cache()
+
+    def __repr__(self):
+        return "Run context for account " + str(self.config.get("account_id"))
+
+    @staticmethod
+    def pooled(session):
+        from requests.adapters import HTTPAdapter
+
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    @property
+    def ls(self):
+        """
+        Rate limited Lightspeed client, created and authorised on first use.
+        """
+        with self.lock:
+            if self._ls is None:
+                import lightspeed_api
+
+                connection = lightspeed_api.Lightspeed(self.config)
+                self.pooled(connection.session)
+                self._ls = lsclient.LightspeedClient(connection, metrics=self.metrics, timeout=self.timeout)
+                self._ls.refresh_token()
+        return self._ls
+
+    @property
+    def vc(self):
+        """
+        Rate limited Veracross client, created on first use.
+        """
+        with self.lock:
+            if self._vc is None:
+                import veracross_api
+
+                connection = veracross_api.Veracross(self.config)
+                self.pooled(connection.session)
+                self.metrics.instrument_session("veracross", connection.session, connection.api_url)
+                self._vc = vcclient.VeracrossClient(connection, metrics=self.metrics, timeout=self.timeout)
+        return self._vc
+
+    def reference(self, name, loader):
+        """
+        Get a reference table from the cache, loading it from Lightspeed when missing or expired.
+        Empty results are not cached.
+        :param name: Cache name, e.g. "CustomerType"
+        :param loader: Callable taking the Lightspeed client and returning the table
+        :return: The table
+        """
+        with self.lock:
+            self.loaders[name] = loader
+            cached = self.references.get(name)
+        if cached and time.time() - cached["fetched_at"] < self.cache_ttl:
+            return cached["value"]
+
+        value = loader(self.ls)
+        if value:
+            with self.lock:
+                self.references[name] = dict(fetched_at=time.time(), value=value)
+            self.save_cache()
+        return value
+
+    def customer_index(self, customer_type_id, loader):
+        """
+        Get the prefetched customer index of a customer type. Only kept between calls with keep_indexes.
+        Customers the sync writes are dropped with forget_customer, so they are looked up again.
+        :param customer_type_id: Lightspeed customerTypeID
+        :param loader: Callable returning the index
+        :return: dictionary of Veracross ID (str) to Customer
+        """
+        if not self.keep_indexes:
+            return loader()
+
+        key = str(customer_type_id)
+        with self.lock:
+            self.loaders["CustomerIndex:" + key] = loader
+            cached = self.indexes.get(key)
+        if cached and time.time() - cached["fetched_at"] < self.cache_ttl:
+            return cached["value"]
+
+        with self.lock:
+            self.written[key] = set()
+        value = loader()
+        with self.lock:
+            self.keep_index(key, value)
+        return value
+
+    def keep_index(self, key, value):
+        # Customers written while the index was loading may have been read before the write.
+        for person_pk in self.written.pop(key, ()):
+            value.pop(person_pk, None)
+        self.indexes[key] = dict(fetched_at=time.time(), value=value)
+
+    def forget_customer(self, customer_type_id, person_pk):
+        """
+        Drop a customer that was just written from the kept index of its customer type.
+        :param customer_type_id: Lightspeed customerTypeID
+        :param person_pk: Veracross person_pk
+        :return: None
+        """
+        if not self.keep_indexes:
+            return
+        key = str(customer_type_id)
+        with self.lock:
+            cached = self.indexes.get(key)
+            if cached:
+                cached["value"].pop(str(person_pk), None)
+            if key in self.written:
+                self.written[key].add(str(person_pk))
+
+    def refresh(self):
+        """
+        Reload every reference table and kept customer index used so far, so a run never waits on an
+        expired one. Tables that fail to load keep their old value.
+        :return: None
+        """
+        with self.lock:
+            loaders = dict(self.loaders)
+
+        for name, loader in sorted(loaders.items()):
+            if name.startswith("CustomerIndex:"):
+                with self.lock:
+                    self.written[name.split(":", 1)[1]] = set()
+            try:
+                if name.startswith("CustomerIndex:"):
+                    value = loader()
+                else:
+                    value = loader(self.ls)
+            except (Exception, SystemExit) as e:
+                applogs.info("Unable to refresh {}: {}".format(name, repr(e)))
+                continue
+
+            with self.lock:
+                if name.startswith("CustomerIndex:"):
+                    self.keep_index(name.split(":", 1)[1], value)
+                elif value:
+                    self.references[name] = dict(fetched_at=time.time(), value=value)
+        self.save_cache()
+
+    def invalidate(self, name=None):
+        """
+        Drop one or all cached reference tables.
+        :param name: Cache name or None for all
+        :return: None
+        """
+        with self.lock:
+            if name is None:
+                self.references.clear()
+            else:
+                self.references.pop(name, None)
+        self.save_cache()
+
+    def cache_key(self):
+        return str(self.config.get("account_id"))
+
+    def load_cache(self):
+        if not self.cache_path or not os.path.isfile(self.cache_path):
+            return
+        try:
+            with open(self.cache_path) as f:
+                self.references = json.load(f).get(self.cache_key(), dict())
+        except (OSError, ValueError):
+            applogs.info("Ignoring unreadable reference cache {}.".format(self.cache_path))
+            self.references = dict()
+
+    def save_cache(self):
+        if not self.cache_path:
+            return
+
+        # Keep other accounts' tables in the same file.
+        cache = dict()
+        try:
+            if os.path.isfile(self.cache_path):
+                with open(self.cache_path) as f:
+                    cache = json.load(f)
+        except (OSError, ValueError):
+            cache = dict()
+
+        with self.lock:
+            cache[self.cache_key()] = dict(self.references)
+
+        # A temporary file of its own, so jobs saving the same cache at once never rename each other's.
+        directory = os.path.dirname(os.path.abspath(self.cache_path))
+        temporary = None
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with tempfile.NamedTemporaryFile("w", dir=directory, prefix=os.path.basename(self.cache_path) + ".",
+                                             suffix=".tmp", delete=False) as f:
+                temporary = f.name
+                json.dump(cache, f)
+            os.replace(temporary, self.cache_path)
+        except OSError:
+            applogs.info("Unable to save reference cache {}.".format(self.cache_path))
+            if temporary and os.path.exists(temporary):
+                os.remove(temporary)
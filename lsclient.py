@@ -0,0 +1,256 @@
+"""
+Rate limited, retrying client for the Lightspeed Retail API.
+"""
+import json
+import logging
+import random
+import threading
+import time
+from urllib import parse
+
+import metrics
+import ratelimit
+
+applogs = logging.getLogger("lsvcconnector")
+
+# Responses worth retrying. Everything else is returned to the caller as a failure.
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# A POST that failed any other way may have been committed, so only a rate limited one is sent again.
+RETRY_STATUS_POST = (429,)
+
+
+class LightspeedError(Exception):
+    """
+    A page of results could not be fetched, even after retries.
+    """
+    pass
+
+
+class LightspeedClient(object):
+    """
+    Drop in replacement for lightspeed_api.Lightspeed get/create/update/delete.
+    Sends requests through the wrapped connection's session, waits on a shared leaky bucket
+    fed by the rate limit headers, and retries 429/5xx and connection errors with jittered
+    exponential backoff. POSTs are only retried on 429, so a create is never sent twice.
+    Every request times out, so a stalled connection fails like any other.
+    Safe to share between worker threads.
+    """
+
+    def __init__(self, lightspeed_connection, bucket=None, retries=5, backoff=1.0, max_backoff=60.0, metrics=None,
+                 timeout=60):
+        """
+        :param lightspeed_connection: lightspeed_api.Lightspeed
+        :param bucket: Optional ratelimit.LeakyBucket shared with other clients
+        :param retries: Retries per request after the first attempt
+        :param backoff: Base backoff in seconds
+        :param max_backoff: Longest single backoff in seconds
+        :param metrics: Optional metrics.Metrics to record each request in
+        :param timeout: Seconds to wait for Lightspeed to connect or send data
+        """
+        self.ls = lightspeed_connection
+        self.bucket = bucket or ratelimit.LeakyBucket()
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.metrics = metrics
+        self.timeout = timeout
+        self.token_lock = threading.Lock()
+
+    def __repr__(self):
+        return "Lightspeed API Client"
+
+    def refresh_token(self, force=False):
+        """
+        Ensures the bearer token is current. Only one thread refreshes at a time.
+        :param force: Refresh even if the token has not expired yet
+        :return: None
+        """
+        with self.token_lock:
+            if force:
+                self.ls.token_expire_time = self.ls.token_expire_time.min
+            self.ls.get_token()
+
+    def url(self, source, parameters=None):
+        if isinstance(parameters, dict) and parameters:
+            return self.ls.api_url + source + ".json?" + parse.urlencode(parameters, safe=':-')
+        elif parameters:
+            return self.ls.api_url + source + ".json?" + parameters
+        return self.ls.api_url + source + ".json"
+
+    def sleep_for(self, attempt, response=None):
+        """
+        Jittered exponential backoff, honouring Retry-After when Lightspeed sends one.
+        :param attempt: Zero based retry number
+        :param response: Failed response, if any
+        :return: Seconds to sleep
+        """
+        delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+        delay = random.uniform(delay / 2, delay)
+
+        if response is not None and "Retry-After" in response.headers:
+            try:
+                delay = max(delay, float(response.headers["Retry-After"]))
+            except ValueError:
+                pass
+
+        return delay
+
+    def request(self, method, url, data=None):
+        """
+        Send one request, retrying transient failures.
+        :param method: get, post, put or delete
+        :param url: Complete API url
+        :param data: JSON encoded body for post/put
+        :return: Decoded JSON or None on failure
+        """
+        from requests.exceptions import RequestException
+
+        if method == "get":
+            units = ratelimit.READ_UNITS
+        else:
+            units = ratelimit.WRITE_UNITS
+
+        if self.metrics is not None:
+            endpoint = metrics.endpoint(self.ls.api_url, url)
+
+        refreshed = False
+        attempt = 0
+        while True:
+            self.refresh_token()
+            waited = self.bucket.acquire(units)
+
+            response = None
+            started = time.perf_counter()
+            try:
+                if method in ("post", "put"):
+                    response = getattr(self.ls.session, method)(url, data=data, timeout=self.timeout)
+                else:
+                    response = getattr(self.ls.session, method)(url, timeout=self.timeout)
+            except RequestException as e:
+                applogs.info("Lightspeed {} {} failed: {}".format(method.upper(), url, e))
+
+            if self.metrics is not None:
+                self.metrics.rate_limit_sleep("lightspeed", waited)
+                if response is None:
+                    self.metrics.api_call("lightspeed", method, endpoint, "error", time.perf_counter() - started)
+                else:
+                    self.metrics.api_call("lightspeed", method, endpoint, response.status_code,
+                                          time.perf_counter() - started, len(response.content or b""))
+
+            # The POST may have reached Lightspeed. Leave it to the caller.
+            if response is None and method == "post":
+                return None
+
+            if response is not None:
+                self.bucket.update(response.headers.get("X-LS-API-Bucket-Level"),
+                                   response.headers.get("X-LS-API-Drip-Rate"))
+
+                if response.status_code == 200:
+                    return response.json()
+
+                # Expired token mid run. Refresh once and try again.
+                if response.status_code == 401 and not refreshed:
+                    refreshed = True
+                    self.refresh_token(force=True)
+                    continue
+
+                if response.status_code not in (RETRY_STATUS_POST if method == "post" else RETRY_STATUS):
+                    applogs.info("Lightspeed {} {} returned {}: {}".format(method.upper(), url,
+                                                                          response.status_code,
+                                                                          response.text[:500]))
+                    return None
+
+            if attempt >= self.retries:
+                applogs.info("Giving up on Lightspeed {} {} after {} attempts.".format(method.upper(), url,
+                                                                                     attempt + 1))
+                return None
+
+            delay = self.sleep_for(attempt, response)
+            if self.metrics is not None:
+                self.metrics.retry("lightspeed", method, endpoint)
+                if response is not None and response.status_code == 429:
+                    self.metrics.rate_limit_sleep("lightspeed", delay)
+            if response is not None:
+                applogs.info("Lightspeed returned {}, retrying in {:.1f}s.".format(response.status_code, delay))
+            time.sleep(delay)
+            attempt += 1
+
+    def iter_pages(self, source, parameters=None):
+        """
+        Get data from API one page at a time, following the @attributes next link.
+        :param source: API Source desired
+        :param parameters: Optional URL Parameters.
+        :return: Generator of JSON pages
+        :raises LightspeedError: when a page cannot be fetched
+        """
+        url = self.url(source, parameters)
+        while url:
+            page = self.request("get", url)
+            if page is None:
+                raise LightspeedError("Unable to get " + url)
+            yield page
+            try:
+                url = page["@attributes"]["next"]
+            except (KeyError, TypeError):
+                url = None
+
+    def get(self, source, parameters=None):
+        """
+        Get data from API with pagination. Same result shape as lightspeed_api.Lightspeed.get.
+        :param source: API Source desired
+        :param parameters: Optional URL Parameters.
+        :return: JSON Results or None if any page failed
+        """
+        r = None
+        try:
+            for page in self.iter_pages(source, parameters):
+                if r is None:
+                    r = page
+                    continue
+
+                # Append new data to original request. A page holding one record returns a dict.
+                for key in page:
+                    if key == "@attributes":
+                        continue
+                    if key not in r:
+                        r[key] = page[key]
+                        continue
+                    if not isinstance(r[key], list):
+                        r[key] = [r[key]]
+                    if isinstance(page[key], list):
+                        r[key].extend(page[key])
+                    else:
+                        r[key].append(page[key])
+        except LightspeedError:
+            return None
+        return r
+
+    def create(self, source, data, parameters=None):
+        """
+        Create new object in API with POST.
+        :param source: API Source
+        :param data: POST Data
+        :param parameters: Optional URL Parameters.
+        :return: JSON Results
+        """
+        return self.request("post", self.url(source, parameters), json.dumps(data))
+
+    def update(self, source, data, parameters=None):
+        """
+        Update object in API using PUT
+        :param source: API Source
+        :param data: PUT Data
+        :param parameters: Optional URL Parameters.
+        :return: JSON Results
+        """
+        return self.request("put", self.url(source, parameters), json.dumps(data))
+
+    def delete(self, source, parameters=None):
+        """
+        Delete object from API
+        :param source: API Source
+        :param parameters: Optional URL Parameters.
+        :return: JSON Results
+        """
+        return self.request("delete", self.url(source, parameters))
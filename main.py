@@ -1,21 +1,55 @@
-import veracross_api
-import lightspeed_api
 import sys
 import getopt
 import os
 import datetime
-import pandas
 import csv
 from decimal import Decimal, ROUND_HALF_UP
 import logging
 import json
-import pytz
-import datetime
+import hashlib
+import collections
+import gzip
+import threading
+import time
+import ratelimit
+import lsclient
+import vcclient
+import context
+import statedb
+import writers
+
+# Keep imports above to the standard library and modules that only import it at load time.
+# The API clients, requests and pytz load when an operation first needs them, so --help,
+# --version and short cron runs don't pay for them. See benchmarks/startup.py.
 
 __version__ = "0.2"
 
+# Sale relations needed to pick Sales for export, and to export them.
+SALE_FILTER_RELATIONS = '["Customer","SalePayments","SalePayments.PaymentType"]'
+SALE_EXPORT_RELATIONS = '["Customer","SaleLines","SaleLines.Item","SaleLines.Note","SalePayments",' \
+                        '"SalePayments.PaymentType"]'
+
+# Address fields of format_vc_person, sent together as the Contact address.
+ADDRESS_FIELDS = ("address_1", "address_2", "city", "zip", "state")
+
+# VC records waiting between two sync stages at most, which bounds memory whatever the roster size.
+SYNC_QUEUE_SIZE = 200
+
+# Format of sync plan files.
+SYNC_PLAN_VERSION = 1
+
+# Returned for a planned action that no longer applies, e.g. a delete of a customer now owing a balance.
+PLAN_SKIPPED = object()
+
+# Days in each export_shard option.
+EXPORT_SHARD_DAYS = {"day": 1, "week": 7}
+
+# SaleLines formatted per batch, and bytes buffered before the export file is written.
+EXPORT_BATCH_LINES = 1000
+EXPORT_WRITE_BUFFER = 1024 * 1024
+
 # Creating logger
-applogs = logging.getLogger(__name__)
+applogs = logging.getLogger("lsvcconnector")
 applogs.setLevel(logging.DEBUG)
 
 # Stream Log
@@ -35,13 +69,31 @@ def print_help():
         --version = Script version
         --help = This text
         --operation = "sync" to performa sync with LS. "export" to export data from LS.       
+            "serve" to keep running and sync incrementally every --serve_interval seconds.
         --config = Complete path to config file from LSVCConnector (see sample_config.json)
         --operation_json = Optional JSON file with sync parameters.
             Mix of JSON and other switches allowed.
             Other switches override JSON.
+            Repeat, or give a directory of JSON files, to run several jobs in one process.
+            Each JSON may set "operation" to "sync" or "export", otherwise --operation is used.
+        --job_workers = Number of jobs to run at once (default 1).
+        --serve_interval = Seconds between syncs with --operation=serve (default 300).
+        --serve_port = Local port for /health and /metrics with --operation=serve (default 9470, 0 for none).
         --type = VC role to sync ("Students" or "Faculty Staff")
         --sync_force = Force update all VC records in LS.
         --sync_delete = Search all LS records and delete all not found in VC.
+        --sync_prefetch = Fetch all LS customers of the type once instead of one lookup per VC record.
+        --sync_incremental = Only sync VC records updated since the last successful sync of this type.
+        --sync_skip_unchanged = Skip VC records unchanged since they were last synced without reading LS.
+        --resume = Resume an interrupted or partly failed sync, retrying only records not done yet.
+        --plan = Complete file path to write the sync's creates, updates and deletes to instead of making them.
+        --apply = Complete file path of a plan to apply to Lightspeed. Applying it again only does what is left.
+        --export_delta = Only export Sales not already exported by an earlier run.
+        --export_reemit = With --export_delta, export the whole date range again.
+        --state_path = Complete file path to the local state database (default ~/.lsvcconnector/state-ACCOUNT.db).
+        --cache_path = Complete file path to keep Lightspeed reference tables between runs.
+        --metrics_path = Complete file path to write a JSON summary of phase timings and API calls.
+        --metrics_prom = Complete file path to write the same metrics as a Prometheus textfile.
         --filter_after_date = Only update records updated in VC after date formatted as YYYY-MM-DD
         --filter_grade_level = Comma seperated list of grades by VC ID to sync ("1,2,3,4,20")
         --log_path = Complete file pathf to where the logfile should be.
@@ -71,64 +123,520 @@ def get_ls_customer_types(lightspeed_connection):
     return ls_customer_types
 
 
-def get_custom_field_id(lightspeed_connection, name):
+def get_custom_fields(lightspeed_connection):
     """
-    Get the Lightspeed id for the customfields
-    :return:
+    Get the Lightspeed ids for the customer custom fields
+    :return: dictionary of custom field name to id
     """
+    custom_field_ids = dict()
+
     try:
         custom_fields = lightspeed_connection.get("Customer/CustomField")
         if isinstance(custom_fields["CustomField"], list):
             for cf in custom_fields["CustomField"]:
-                # Find internal id for named field
-                if str(cf["name"]) == str(name):
-                    return cf["customFieldID"]
+                custom_field_ids[str(cf["name"])] = cf["customFieldID"]
         else:
-            return None
+            cf = custom_fields["CustomField"]
+            custom_field_ids[str(cf["name"])] = cf["customFieldID"]
     except:
-        return None
+        applogs.info("Cannot get customer custom fields from Lightspeed API, or none exist.")
 
+    return custom_field_ids
 
-def delete_customer(config):
+
+def get_ls_customer_index(lightspeed_connection, customer_type_id):
+    """
+    Page through all Lightspeed customers of a customer type once and index them by Veracross ID.
+    Customers are keyed by companyRegistrationNumber and by Contact custom field.
+    :param lightspeed_connection: Lightspeed connection
+    :param customer_type_id: Lightspeed customerTypeID to prefetch
+    :return: dictionary of Veracross ID (str) to Customer
+    :raises LightspeedError: when the customers cannot be fetched, so a failed prefetch is never taken
+                             for a customer type with no customers
+    """
+    ls_customer_index = dict()
+
+    parameters = dict(load_relations='["Contact","CreditAccount"]', customerTypeID=customer_type_id, limit=100)
+    customers = lightspeed_connection.get("Customer", parameters=parameters)
+    if customers is None:
+        applogs.info("Unable to prefetch customers from Lightspeed.")
+        raise lsclient.LightspeedError("Unable to prefetch customers of customerTypeID {}".format(customer_type_id))
+
+    if "Customer" not in customers:
+        return ls_customer_index
+
+    if isinstance(customers["Customer"], list):
+        customer_list = customers["Customer"]
+    else:
+        customer_list = [customers["Customer"]]
+
+    for customer in customer_list:
+        if customer["companyRegistrationNumber"] != '':
+            ls_customer_index[str(customer["companyRegistrationNumber"])] = customer
+
+    # Fall back to the Contact custom field for customers missing companyRegistrationNumber.
+    for customer in customer_list:
+        try:
+            custom = str(customer["Contact"]["custom"])
+        except:
+            continue
+        if custom != '' and custom not in ls_customer_index:
+            ls_customer_index[custom] = customer
+
+    applogs.info("Prefetched {} Lightspeed customers of customerTypeID {}.".format(len(customer_list),
+                                                                                  customer_type_id))
+    return ls_customer_index
+
+
+def find_ls_customer(lightspeed_connection, person_pk, ls_customer_index=None):
+    """
+    Find the Lightspeed customer for a Veracross person.
+    Uses the prefetched index when available and falls back to a single API lookup on a miss,
+    so customers filed under another customer type are still found.
+    :param lightspeed_connection: Lightspeed connection
+    :param person_pk: Veracross person_pk
+    :param ls_customer_index: Optional index from get_ls_customer_index
+    :return: dict with a single Customer or None when there is no such customer
+    :raises LightspeedError: when the lookup fails, so a failed lookup is never taken for a missing customer
+    """
+    if ls_customer_index is not None:
+        customer = ls_customer_index.get(str(person_pk))
+        if customer:
+            return {"Customer": customer}
+
+    lsparam = dict(load_relations='all', limit=1, companyRegistrationNumber=str(person_pk))
+    for customer in iter_ls_records(lightspeed_connection, "Customer", lsparam):
+        return {"Customer": customer}
+
+    return None
+
+
+class HouseholdCache(object):
+    """
+    Veracross households keyed by household_fk so each household is pulled once per run.
+    Shared by the sync's compare workers.
+    """
+
+    def __init__(self, veracross_connection):
+        self.vc = veracross_connection
+        self.lock = threading.Lock()
+        self.households = dict()
+        # Events of households being pulled, set once the pull is done.
+        self.pending = dict()
+        self.hits = 0
+        self.misses = 0
+        self.pulls = 0
+
+    def load_all(self):
+        """
+        Fill the cache with one paginated pull of every household.
+        :return: None
+        """
+        with self.lock:
+            self.pulls += 1
+        households = self.vc.pull("households")
+        if households:
+            with self.lock:
+                for h in households:
+                    self.households[str(h["household_pk"])] = h
+
+    def get(self, household_fk):
+        """
+        Get a household, pulling it from Veracross if it is not cached. When several workers want
+        the same household at once, one pulls it and the others wait for its result.
+        :param household_fk: household_fk from a Veracross person record
+        :return: household dictionary or None
+        """
+        household_fk = str(household_fk)
+        with self.lock:
+            if household_fk in self.households:
+                self.hits += 1
+                return self.households[household_fk]
+            pulling = self.pending.get(household_fk)
+            if pulling is None:
+                self.misses += 1
+                self.pulls += 1
+                pulling = self.pending[household_fk] = threading.Event()
+                puller = True
+            else:
+                self.hits += 1
+                puller = False
+
+        if not puller:
+            pulling.wait()
+            with self.lock:
+                return self.households.get(household_fk)
+
+        try:
+            hh = self.vc.pull("households/" + household_fk)
+            with self.lock:
+                if hh and "household" in hh:
+                    self.households[household_fk] = hh["household"]
+                return self.households.get(household_fk)
+        finally:
+            with self.lock:
+                del self.pending[household_fk]
+            pulling.set()
+
+    def log_stats(self):
+        applogs.info("Household cache: {} hits, {} misses, {} households from {} pulls.".format(
+            self.hits, self.misses, len(self.households), self.pulls))
+
+
+def delete_customer(config, operation_json=None, ctx=None):
     """
     Delete records in Lightspeed.  Filters customers to those that have a companyRegistrationNumber
     :return:
     """
     c = config
-    ls = lightspeed_api.Lightspeed(c)
-    vc = veracross_api.Veracross(c)
-
-    valid_vc_ids = []
-    for i in vc.pull("facstaff", parameters=dict(roles='1,2')):
-        valid_vc_ids.append(i["person_pk"])
-    for i in vc.pull("students", parameters=dict(option="2")):
-        valid_vc_ids.append(i["person_pk"])
-
-    current_customers = ls.get("Customer", dict(load_relations="all"))
-
-    for i in current_customers["Customer"]:
-        if i["companyRegistrationNumber"] != '':
-            if int(i["companyRegistrationNumber"]) not in valid_vc_ids:
-                if float(i["CreditAccount"]["balance"]) <= 0:
-                    applogs.info("Deleting customer {} {}".format(i["firstName"], i["lastName"]))
-                    ls.delete("Customer/" + i["customerID"])
-                else:
-                    applogs.info("Cannot delete customer {}, {} {} with credit balance.".format(i["customerID"],
-                                                                                         i["firstName"],
-                                                                                         i["lastName"]))
+    if ctx is None:
+        ctx = context.RunContext(c)
+    ls = ctx.ls
+    vc = ctx.vc
+
+    if operation_json is None:
+        operation_json = dict()
+
+    watch = ctx.metrics.stopwatch("delete")
+    missing = find_missing_customers(ls, vc, watch)
+    if missing is None:
+        return
+    to_delete, skipped = missing
+
+    def delete(i):
+        applogs.info("Deleting customer {} {}".format(i["firstName"], i["lastName"]))
+        if ls.delete("Customer/" + i["customerID"]) is None:
+            raise ValueError("Lightspeed did not delete customer {}.".format(i["customerID"]))
+
+    watch.start("delete")
+    workers = int(operation_json.get("sync_workers", 4))
+    results = ratelimit.run_concurrent(delete, to_delete, workers)
+    watch.stop()
+
+    failed = 0
+    for i, result, error in results:
+        if error is not None:
+            failed += 1
+            applogs.info("Unable to delete customer {}, {} {}: {}".format(i["customerID"], i["firstName"],
+                                                                         i["lastName"], error))
+
+    applogs.info("Delete: {} deleted, {} skipped with credit balance, {} failed.".format(len(to_delete) - failed,
+                                                                                       skipped,
+                                                                                       failed))
+    ctx.metrics.record("delete", "deleted", len(to_delete) - failed)
+    ctx.metrics.record("delete", "skipped", skipped)
+    ctx.metrics.record("delete", "failed", failed)
+
+
+def find_missing_customers(ls, vc, watch):
+    """
+    Find Lightspeed customers no longer current in Veracross. Customers with a credit balance are kept.
+    :param ls: lsclient.LightspeedClient
+    :param vc: vcclient.VeracrossClient
+    :param watch: metrics.Stopwatch of the calling operation
+    :return: (customers to delete, number kept for their balance), or None when either side failed
+    """
+    watch.start("vc_pull")
+
+    # Everyone current in Veracross, faculty and students pulled at once.
+    # A failed pull must not look like an empty school.
+    try:
+        valid_vc_ids = set(str(i["person_pk"]) for i in
+                           iter_vc_people(vc, [("facstaff", dict(roles='1,2')), ("students", dict(option="2"))]))
+    except vcclient.VeracrossError as e:
+        applogs.info("{}. Not deleting any customers.".format(e))
+        return None
+
+    if not valid_vc_ids:
+        applogs.info("No current Veracross records found. Not deleting any customers.")
+        return None
+
+    # Find customers no longer in Veracross in one pass over all customers.
+    watch.start("scan")
+    to_delete = []
+    skipped = 0
+    try:
+        for i in iter_ls_records(ls, "Customer", dict(load_relations='["CreditAccount"]', limit=100)):
+            if i["companyRegistrationNumber"] == '':
+                continue
+
+            try:
+                vc_id = str(int(i["companyRegistrationNumber"]))
+            except ValueError:
+                continue
+
+            if vc_id in valid_vc_ids:
+                continue
+
+            if "CreditAccount" in i and float(i["CreditAccount"]["balance"]) > 0:
+                applogs.info("Cannot delete customer {}, {} {} with credit balance.".format(i["customerID"],
+                                                                                     i["firstName"],
+                                                                                     i["lastName"]))
+                skipped += 1
+                continue
+
+            to_delete.append(i)
+    except lsclient.LightspeedError:
+        applogs.info("Unable to get customers from Lightspeed. Not deleting any customers.")
+        return None
+
+    return to_delete, skipped
+
+
+def iter_vc_people(vc, pulls):
+    """
+    Stream the people of several Veracross pulls fetched at once, each person once.
+    :param vc: vcclient.VeracrossClient
+    :param pulls: list of (source, parameters)
+    :return: Generator of people
+    :raises vcclient.VeracrossError: when a page cannot be fetched
+    """
+    seen = set()
+    for person in vc.iter_pulls(pulls):
+        if person["person_pk"] not in seen:
+            seen.add(person["person_pk"])
+            yield person
+
+
+def format_vc_person(i, h):
+    """
+    Format a Veracross person and household for comparison with format_ls_customer.
+    :param i: Veracross person record
+    :param h: Veracross household record
+    :return: dict
+    """
+    vc_person = dict()
+
+    vc_person["personpk"] = str(i["person_pk"])
+    vc_person["last_name"] = i["last_name"]
+    if 'nick_first_name' in i:
+        vc_person["first_name"] = i['nick_first_name']
+    elif 'first_nick_name' in i:
+        vc_person["first_name"] = i['first_nick_name']
+
+    # Handle missing email
+    if i["email_1"] is None:
+        vc_person["email"] = ''
+    else:
+        vc_person["email"] = i["email_1"]
+
+    vc_person["address_1"] = h["address_1"]
+    if h["address_2"] is None:
+        vc_person["address_2"] = ''
+    else:
+        vc_person["address_2"] = h["address_2"]
+    vc_person["city"] = h["city"]
+    vc_person["zip"] = h["postal_code"]
+    vc_person["state"] = h["state_province"]
+
+    return vc_person
+
+
+def format_ls_customer(customer):
+    """
+    Format a Lightspeed customer for comparison with format_vc_person.
+    :param customer: Lightspeed Customer with Contact relation
+    :return: dict
+    """
+    ls_customer = dict()
+
+    try:
+        ls_customer["personpk"] = str(customer["Contact"]["custom"])
+    except:
+        ls_customer["personpk"] = ""
+
+    ls_customer["last_name"] = customer["lastName"]
+    ls_customer["first_name"] = customer["firstName"]
+
+    # Handle missing email addresses.
+    try:
+        ls_customer["email"] = customer["Contact"]["Emails"]["ContactEmail"]["address"]
+    except:
+        ls_customer["email"] = ''
+
+    # Handle missing mailing addresses
+    try:
+        ls_customer["address_1"] = customer["Contact"]["Addresses"]["ContactAddress"]["address1"]
+        ls_customer["address_2"] = customer["Contact"]["Addresses"]["ContactAddress"]["address2"]
+        ls_customer["city"] = customer["Contact"]["Addresses"]["ContactAddress"]["city"]
+        ls_customer["zip"] = customer["Contact"]["Addresses"]["ContactAddress"]["zip"]
+        ls_customer["state"] = customer["Contact"]["Addresses"]["ContactAddress"]["state"]
+    except:
+        ls_customer["address_1"] = ''
+        ls_customer["address_2"] = ''
+        ls_customer["city"] = ''
+        ls_customer["zip"] = ''
+        ls_customer["state"] = ''
+
+    return ls_customer
+
+
+def customer_changes(ls_customer, vc_person):
+    """
+    Fields that differ between a formatted Lightspeed customer and Veracross person.
+    :param ls_customer: dict from format_ls_customer
+    :param vc_person: dict from format_vc_person
+    :return: sorted list of field names, empty when they match
+    """
+    return sorted(k for k in set(ls_customer) | set(vc_person) if ls_customer.get(k) != vc_person.get(k))
+
+
+def credit_limit_changed(customer, current):
+    """
+    Does the credit limit in Lightspeed differ from the configured one?
+    :param customer: Complete Customer as it should be in Lightspeed
+    :param current: Customer currently in Lightspeed
+    :return: bool, False when current was loaded without its CreditAccount
+    """
+    try:
+        return float(current["CreditAccount"]["creditLimit"]) != float(customer["CreditAccount"]["creditLimit"])
+    except (KeyError, TypeError, ValueError):
+        return False
+
+
+def customer_update(customer, changes, current, lastsync_custom_id, force=False):
+    """
+    Build an update with only the changed parts of a Customer, plus the Last Sync field.
+    :param customer: Complete Customer as it should be in Lightspeed
+    :param changes: Changed fields from customer_changes, plus "credit_limit" from credit_limit_changed
+    :param current: Customer currently in Lightspeed
+    :param lastsync_custom_id: customFieldID of the Last Sync field
+    :param force: Forced sync, which always sends the credit limit
+    :return: Customer data for a PUT
+    """
+    data = dict(customerID=current["customerID"])
+
+    if "first_name" in changes or "last_name" in changes:
+        data["firstName"] = customer["firstName"]
+        data["lastName"] = customer["lastName"]
+
+    contact = dict()
+    if "personpk" in changes:
+        contact["custom"] = customer["Contact"]["custom"]
+    if "email" in changes:
+        contact["Emails"] = customer["Contact"]["Emails"]
+    if set(changes) & set(ADDRESS_FIELDS):
+        contact["Addresses"] = customer["Contact"]["Addresses"]
+    if contact:
+        data["Contact"] = contact
+
+    if force or "credit_limit" in changes:
+        data["CreditAccount"] = customer["CreditAccount"]
+
+    # Customers found by their Contact custom field may be filed under another number or type.
+    if str(current.get("companyRegistrationNumber")) != str(customer["companyRegistrationNumber"]):
+        data["companyRegistrationNumber"] = customer["companyRegistrationNumber"]
+    if str(current.get("customerTypeID")) != str(customer["customerTypeID"]):
+        data["customerTypeID"] = customer["customerTypeID"]
+
+    data["CustomFieldValues"] = dict(CustomFieldValue=[
+        v for v in customer["CustomFieldValues"]["CustomFieldValue"]
+        if v["customFieldID"] == lastsync_custom_id or "companyRegistrationNumber" in data])
+    return data
+
+
+def vc_person_hash(vc_person, customer_type_id):
+    """
+    Hash of the formatted VC data and customer type a record is synced with.
+    :param vc_person: dict from format_vc_person
+    :param customer_type_id: Lightspeed customerTypeID
+    :return: hex digest
+    """
+    payload = json.dumps([vc_person, str(customer_type_id)], sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def write_ls_customer(lightspeed_connection, job):
+    """
+    Create or update a single Lightspeed customer.
+    :param lightspeed_connection: Lightspeed connection
+    :param job: dict with action ("create" or "update"), person_pk and Customer data
+    :return: Customer returned by Lightspeed
+    """
+    if job["action"] == "update":
+        r = lightspeed_connection.update("Customer/" + str(job["data"]["customerID"]), job["data"])
+    else:
+        r = lightspeed_connection.create("Customer", job["data"])
+
+    if not r or "Customer" not in r:
+        raise ValueError("Lightspeed did not accept {} of VC Record {}.".format(job["action"], job["person_pk"]))
 
+    return r["Customer"]
 
-def sync_ls_vc(config, operation_json):
+
+def log_write_results(results):
+    """
+    Log the outcome of each customer write and a summary.
+    :param results: list of (job, customer, exception) from ratelimit.run_concurrent
+    :return: list of failed jobs
+    """
+    counts = {"create": 0, "update": 0}
+    failed = []
+
+    for job, customer, error in results:
+        if error is None:
+            counts[job["action"]] += 1
+            if job["action"] == "create":
+                applogs.info("New Customer # {} Added: {} {}".format(customer['customerID'],
+                                                                     customer['firstName'],
+                                                                     customer['lastName']))
+        else:
+            failed.append(job)
+            applogs.info("Unable to {} Lightspeed Customer for VC Record {}: {}".format(job["action"],
+                                                                                       job["person_pk"],
+                                                                                       error))
+
+    applogs.info("Sync writes: {} created, {} updated, {} failed.".format(counts["create"],
+                                                                         counts["update"],
+                                                                         len(failed)))
+    return failed
+
+
+def sync_key(operation_json):
+    """
+    Name the state of a sync by its type and grade level filter, so differently filtered
+    syncs of the same type keep their own last sync mark.
+    :param operation_json: operation options
+    :return: str
+    """
+    key = str(operation_json["type"])
+    grade_level = operation_json["sync_filters"].get("grade_level")
+    if grade_level:
+        if isinstance(grade_level, list):
+            grade_level = ",".join(str(item) for item in grade_level)
+        key = key + ":" + str(grade_level)
+    return key
+
+
+def open_state(config, operation_json):
+    """
+    Open the state database of the Lightspeed account in config.
+    :param config: config dictionary
+    :param operation_json: operation options
+    :return: statedb.StateDB
+    """
+    try:
+        return statedb.StateDB(operation_json.get("state_path"), config.get("account_id"))
+    except ValueError as e:
+        applogs.info("{} Give each account its own state_path.".format(e))
+        sys.exit(2)
+
+
+def sync_ls_vc(config, operation_json, ctx=None):
 
     c = config
-    ls = lightspeed_api.Lightspeed(c)
-    vc = veracross_api.Veracross(c)
+    if ctx is None:
+        ctx = context.RunContext(c)
+    ls = ctx.ls
+    vc = ctx.vc
 
     # Make sure we have a lastsync and veracross id field mapped.
     if c["import_options_veracrossid"] is None or c["import_options_lastsync"] is None:
         applogs.info("Missing import_options_veracrossid or import_options_lastsync in config file.")
         sys.exit(2)
 
+    watch = ctx.metrics.stopwatch("sync")
+
     # Placeholder for parameters
     param = {}
 
@@ -137,7 +645,41 @@ def sync_ls_vc(config, operation_json):
         if operation_json["sync_filters"]["after_date"]:
             param.update({"updated_after": str(operation_json["sync_filters"]["after_date"])})
 
-    # If we are working with students, add additional parameters.
+    # Incremental sync picks up from the last successful run, less an overlap window.
+    sync_started = datetime.datetime.now()
+    state = open_state(config, operation_json)
+
+    # Every record's outcome is journaled, so an interrupted or partly failed run can be resumed.
+    # Resuming skips records already settled and keeps the run's original start for the sync mark.
+    key = sync_key(operation_json)
+    checkpoints = dict()
+    last_run = state.get_sync_run(key)
+
+    # A plan only records what the sync would write, for apply_sync_plan to write later.
+    plan_path = operation_json.get("sync_plan")
+    if plan_path:
+        applogs.info("Planning sync to {}. Nothing is written to Lightspeed.".format(plan_path))
+    elif operation_json.get("sync_resume") and last_run and (last_run["finished_at"] is None or last_run["failed"]):
+        checkpoints = dict((p, o) for p, o in state.get_checkpoints(key).items() if o != "failed")
+        sync_started = last_run["started_at"]
+        applogs.info("Resuming sync started {}. {} records already done.".format(sync_started, len(checkpoints)))
+    else:
+        if operation_json.get("sync_resume"):
+            applogs.info("No unfinished sync to resume. Syncing all records.")
+        state.start_sync_run(key, sync_started)
+
+    if operation_json.get("sync_incremental"):
+        last_sync = state.get_sync_mark(key)
+        if "updated_after" in param:
+            applogs.info("after_date is set, ignoring last successful sync.")
+        elif last_sync:
+            overlap = datetime.timedelta(days=int(operation_json.get("sync_overlap_days", 1)))
+            param.update({"updated_after": (last_sync - overlap).strftime("%Y-%m-%d")})
+            applogs.info("Last successful sync was {}.".format(last_sync))
+        else:
+            applogs.info("No previous successful sync found. Syncing all records.")
+
+    # Veracross pulls for this type, streamed into the sync as each page arrives.
     if "type" in operation_json:
         if operation_json["type"] == "Students":
             applogs.info("Getting Veracross Students (Current)")
@@ -154,12 +696,16 @@ def sync_ls_vc(config, operation_json):
             # Show our parameters to console
             applogs.info("VC Parameters: " + str(param))
 
-            # Get Veracross data for students
-            vcdata = vc.pull("students", parameters=param)
+            # One pull per grade fetched at once when there are several.
+            grades = operation_json["sync_filters"].get("grade_level")
+            if isinstance(grades, list) and len(grades) > 1:
+                pulls = [("students", dict(param, grade_level=str(g))) for g in grades]
+            else:
+                pulls = [("students", param)]
 
             # Get Lightspeed id number that matches customer_type Student
             try:
-                ls_customer_types = get_ls_customer_types(ls)
+                ls_customer_types = ctx.reference("CustomerType", get_ls_customer_types)
                 ls_customerTypeID = ls_customer_types["Student"]
             except:
                 applogs.info("Unable to assign customer type from Lightspeed")
@@ -175,12 +721,11 @@ def sync_ls_vc(config, operation_json):
             # Show parameters log
             applogs.info("VC Parameters: " + str(param))
 
-            # Get Veracross data for Faculty Staff
-            vcdata = vc.pull("facstaff", parameters=param)
+            pulls = [("facstaff", param)]
 
             # Determine what Lightspeed customer id number for FacStaff
             try:
-                ls_customer_types = get_ls_customer_types(ls)
+                ls_customer_types = ctx.reference("CustomerType", get_ls_customer_types)
                 ls_customerTypeID = ls_customer_types["FacultyStaff"]
             except:
                 applogs.info("Unable to assign customer type from Lightspeed")
@@ -191,170 +736,499 @@ def sync_ls_vc(config, operation_json):
         applogs.info("type of 'Faculty Staff' or 'Students' not found in sync options json file.")
         sys.exit(2)
 
-    if vcdata:
-        # Get field IDs
-        vc_custom_id = get_custom_field_id(ls, str(c["import_options_veracrossid"]))
-        lastsync_custom_id = get_custom_field_id(ls, str(c["import_options_lastsync"]))
-
-        # Loop through the data from VC.
-        for i in vcdata:
-
-            applogs.info("Processing VC Record {}".format(i["person_pk"]))
-
-            # Get household data for this person
-            hh = vc.pull("households/" + str(i["household_fk"]))
-            h = hh["household"]
-
-            # Set search parameters for lightspeed and see if we find someone in LS.
-            lsparam = dict(load_relations='all', limit=1, companyRegistrationNumber=str(i["person_pk"]))
-            check_current = ls.get("Customer", parameters=lsparam)
-
-            # Format data to how it should look. First name will format later.
-            vc_formatted = {'Customer':
-                                {'firstName': '',
-                                 'lastName': i["last_name"],
-                                 'companyRegistrationNumber': i["person_pk"],
-                                 'customerTypeID': ls_customerTypeID,
-                                 'Contact': {
-                                     'custom': i["person_pk"],
-                                     'noEmail': 'false',
-                                     'noPhone': 'false',
-                                     'noMail': 'false',
-                                     'Emails': {
-                                         'ContactEmail': {
-                                             'address': i["email_1"],
-                                             'useType': 'Primary'
-                                         }
-                                     },
-                                     'Addresses': {
-                                         'ContactAddress': {
-                                             'address1': h["address_1"],
-                                             'address2': h["address_2"],
-                                             'city': h["city"],
-                                             'state': h["state_province"],
-                                             'zip': h["postal_code"],
-                                             'country': h["country"],
-                                             'countryCode': '',
-                                             'stateCode': ''
-                                         }
+    # Get field IDs
+    custom_field_ids = ctx.reference("CustomField", get_custom_fields)
+    vc_custom_id = custom_field_ids.get(str(c["import_options_veracrossid"]))
+    lastsync_custom_id = custom_field_ids.get(str(c["import_options_lastsync"]))
+
+    # Prefetch all Lightspeed customers of this type once instead of looking up each record, and pull
+    # each household once. A full roster is cheaper to fill with one paginated pull of all households,
+    # a filtered set with one pull per distinct household as its records arrive. Both load at once.
+    watch.start("prefetch")
+    households = HouseholdCache(vc)
+    ls_customer_index = None
+    preloads = dict()
+    if operation_json.get("sync_prefetch"):
+        applogs.info("Prefetching Lightspeed customers.")
+        preloads["customers"] = lambda: ctx.customer_index(ls_customerTypeID,
+                                                           lambda: get_ls_customer_index(ls, ls_customerTypeID))
+    if "updated_after" not in param and "grade_level" not in param:
+        preloads["households"] = households.load_all
+    for name, result, error in ratelimit.run_concurrent(lambda name: preloads[name](), list(preloads),
+                                                        len(preloads)):
+        if error is not None:
+            state.close()
+            raise error
+        if name == "customers":
+            ls_customer_index = result
+
+    if operation_json["sync_force"]:
+        force = True
+        applogs.info("Force sync enabled.")
+    else:
+        force = False
+    stamp_unchanged = operation_json.get("sync_stamp_unchanged", True)
+
+    # Hashes of the VC data each record was last synced with.
+    if operation_json.get("sync_skip_unchanged"):
+        vc_hashes = state.get_person_hashes()
+    else:
+        vc_hashes = None
+
+    # Compare workers share these.
+    lock = threading.Lock()
+    counts = dict(processed=0, unchanged=0, resumed=0, missing_households=0, failed=0)
+
+    # Records found up to date in Lightspeed, as (person_pk, vc hash, customerID).
+    up_to_date = []
+
+    # Outcomes not yet journaled, flushed every 100 records.
+    journal = []
+
+    def settle(person_pk, outcome, count=None):
+        with lock:
+            if count:
+                counts[count] += 1
+            if plan_path:
+                return
+            journal.append((person_pk, outcome))
+            if len(journal) < 100:
+                return
+            flush = journal[:]
+            del journal[:]
+        state.set_checkpoints(key, flush)
+
+    def compare(i):
+        """
+        Compare one VC record with Lightspeed. A record that cannot be compared fails on its own
+        instead of stopping the pipeline.
+        :return: The create or update to write, or None when there is nothing to write
+        """
+        started = time.perf_counter()
+        try:
+            return compare_record(i)
+        except Exception as e:
+            applogs.info("Unable to compare VC Record {}: {}".format(i.get("person_pk"), repr(e)))
+            ctx.metrics.record("sync", "failed")
+            settle(i.get("person_pk"), "failed", "failed")
+            return None
+        finally:
+            ctx.metrics.add_phase("sync", "compare", time.perf_counter() - started)
+
+    def compare_record(i):
+        with lock:
+            counts["processed"] += 1
+            if str(i["person_pk"]) in checkpoints:
+                counts["resumed"] += 1
+                return None
+
+        applogs.info("Processing VC Record {}".format(i["person_pk"]))
+
+        # Get household data for this person
+        h = households.get(i["household_fk"])
+        if h is None:
+            applogs.info("Unable to get household {} for VC Record {}.".format(i["household_fk"],
+                                                                               i["person_pk"]))
+            ctx.metrics.record("sync", "failed")
+            settle(i["person_pk"], "failed", "missing_households")
+            return None
+
+        # Format VC Data for comparison
+        vc_person = format_vc_person(i, h)
+        vc_hash = vc_person_hash(vc_person, ls_customerTypeID)
+
+        # Skip without touching Lightspeed when the VC data matches what was last synced.
+        if vc_hashes is not None and not force and vc_hashes.get(str(i["person_pk"])) == vc_hash:
+            applogs.info("Record {} unchanged since last sync.".format(i["person_pk"]))
+            settle(i["person_pk"], "unchanged", "unchanged")
+            return None
+
+        # See if we find someone in LS. A failed lookup fails the record rather than creating a duplicate.
+        try:
+            check_current = find_ls_customer(ls, i["person_pk"], ls_customer_index)
+        except lsclient.LightspeedError as e:
+            applogs.info("Unable to look up VC Record {} in Lightspeed: {}".format(i["person_pk"], e))
+            ctx.metrics.record("sync", "failed")
+            settle(i["person_pk"], "failed", "failed")
+            return None
+
+        # Format data to how it should look. First name will format later.
+        vc_formatted = {'Customer':
+                            {'firstName': '',
+                             'lastName': i["last_name"],
+                             'companyRegistrationNumber': i["person_pk"],
+                             'customerTypeID': ls_customerTypeID,
+                             'Contact': {
+                                 'custom': i["person_pk"],
+                                 'noEmail': 'false',
+                                 'noPhone': 'false',
+                                 'noMail': 'false',
+                                 'Emails': {
+                                     'ContactEmail': {
+                                         'address': i["email_1"],
+                                         'useType': 'Primary'
                                      }
                                  },
-                                 'CreditAccount': {
-                                     'creditLimit': str(c["import_options_creditamount"]) + '.00'
-                                 },
-                                 'CustomFieldValues': {
-                                     'CustomFieldValue': [{
-                                         'customFieldID': vc_custom_id,
-                                         'value': str(i["person_pk"])
-                                     }, {
-                                         'customFieldID': lastsync_custom_id,
-                                         'value': str(datetime.datetime.now())
+                                 'Addresses': {
+                                     'ContactAddress': {
+                                         'address1': h["address_1"],
+                                         'address2': h["address_2"],
+                                         'city': h["city"],
+                                         'state': h["state_province"],
+                                         'zip': h["postal_code"],
+                                         'country': h["country"],
+                                         'countryCode': '',
+                                         'stateCode': ''
                                      }
-                                     ]}
                                  }
-                            }
-
-            # Update data to use correct nick name format from VC.
-            # Added because of bug in VC API where sometimes one is returned over other.
-            if 'nick_first_name' in i:
-                vc_formatted['Customer']['firstName'] = i['nick_first_name']
-            elif 'first_nick_name' in i:
-                vc_formatted['Customer']['firstName'] = i['first_nick_name']
-
-            # Did we find a record in Lighspeed to sync to?
-            if check_current:
-
-                # Create two dictionaries one for VC and the other for LS
-                # We will see if they match later.
-                vc_person = dict()
-                ls_customer = dict()
-
-                # Format VC Data for comparison
-                vc_person["personpk"] = str(i["person_pk"])
-                vc_person["last_name"] = i["last_name"]
-                if 'nick_first_name' in i:
-                    vc_person["first_name"] = i['nick_first_name']
-                elif 'first_nick_name' in i:
-                    vc_person["first_name"] = i['first_nick_name']
-
-                # Handle missing email
-                if i["email_1"] is None:
-                    vc_person["email"] = ''
-                else:
-                    vc_person["email"] = i["email_1"]
+                             },
+                             'CreditAccount': {
+                                 'creditLimit': str(c["import_options_creditamount"]) + '.00'
+                             },
+                             'CustomFieldValues': {
+                                 'CustomFieldValue': [{
+                                     'customFieldID': vc_custom_id,
+                                     'value': str(i["person_pk"])
+                                 }, {
+                                     'customFieldID': lastsync_custom_id,
+                                     'value': str(datetime.datetime.now())
+                                 }
+                                 ]}
+                             }
+                        }
 
-                vc_person["address_1"] = h["address_1"]
-                if h["address_2"] is None:
-                    vc_person["address_2"] = ''
-                else:
-                    vc_person["address_2"] = h["address_2"]
-                vc_person["city"] = h["city"]
-                vc_person["zip"] = h["postal_code"]
-                vc_person["state"] = h["state_province"]
-
-                # Format LS Data for comparison
-                try:
-                    ls_customer["personpk"] = str(check_current["Customer"]["Contact"]["custom"])
-                except:
-                    ls_customer["personpk"] = ""
-
-                ls_customer["last_name"] = check_current["Customer"]["lastName"]
-                ls_customer["first_name"] = check_current["Customer"]["firstName"]
-
-                # Handle missing email addresses.
-                try:
-                    ls_customer["email"] = check_current["Customer"]["Contact"]["Emails"]["ContactEmail"]["address"]
-                except:
-                    ls_customer["email"] = ''
-
-                # Handle missing mailing addresses
-                try:
-                    ls_customer["address_1"] = check_current["Customer"]["Contact"]["Addresses"]["ContactAddress"][
-                        "address1"]
-                    ls_customer["address_2"] = check_current["Customer"]["Contact"]["Addresses"]["ContactAddress"][
-                        "address2"]
-                    ls_customer["city"] = check_current["Customer"]["Contact"]["Addresses"]["ContactAddress"]["city"]
-                    ls_customer["zip"] = check_current["Customer"]["Contact"]["Addresses"]["ContactAddress"]["zip"]
-                    ls_customer["state"] = check_current["Customer"]["Contact"]["Addresses"]["ContactAddress"]["state"]
-                except:
-                    ls_customer["address_1"] = ''
-                    ls_customer["address_2"] = ''
-                    ls_customer["city"] = ''
-                    ls_customer["zip"] = ''
-                    ls_customer["state"] = ''
-
-                # Compare the data. Are the two dictionaries the same...
-                if operation_json["sync_force"]:
-                    force = True
-                    applogs.info("Force sync enabled.")
+        # Update data to use correct nick name format from VC.
+        # Added because of bug in VC API where sometimes one is returned over other.
+        if 'nick_first_name' in i:
+            vc_formatted['Customer']['firstName'] = i['nick_first_name']
+        elif 'first_nick_name' in i:
+            vc_formatted['Customer']['firstName'] = i['first_nick_name']
+
+        # Did we find a record in Lighspeed to sync to?
+        if check_current:
+
+            # Format LS Data for comparison with the VC data formatted above.
+            ls_customer = format_ls_customer(check_current["Customer"])
+
+            # Compare the data field by field and only send what changed. Forced records that already
+            # match only get their Last Sync field updated, or are skipped.
+            changes = customer_changes(ls_customer, vc_person)
+            if credit_limit_changed(vc_formatted["Customer"], check_current["Customer"]):
+                changes.append("credit_limit")
+            if changes or (force and stamp_unchanged):
+                if changes:
+                    applogs.info("Updating customer {} {}: {}.".format(vc_formatted['Customer']['firstName'],
+                                                                       vc_formatted['Customer']['lastName'],
+                                                                       ", ".join(changes)))
                 else:
-                    force = False
-
-                if not ls_customer == vc_person or force:
-                    applogs.info("Updating customer {} {}.".format(vc_formatted['Customer']['firstName'],
-                                                            vc_formatted['Customer']['lastName']))
-                    vc_formatted['Customer']['customerID'] = check_current['Customer']['customerID']
-                    # applogs.info(vc_formatted["Customer"])
-                    ls.update("Customer/" + vc_formatted['Customer']['customerID'], vc_formatted["Customer"])
-                else:
-                    applogs.info("Record {} {} already up to date.".format(
-                        vc_formatted['Customer']['firstName'],
-                        vc_formatted['Customer']['lastName']))
-            else:
-                # Add new user when not found in LS
-                applogs.info("Adding new Lightspeed Customer for {} {}".format(
-                    vc_formatted['Customer']['firstName'],
-                    vc_formatted['Customer']['lastName']))
-                try:
-                    new_customer = ls.create("Customer", vc_formatted["Customer"])
-                    applogs.info("New Customer # {} Added: {} {}".format(
-                        new_customer['Customer']['customerID'],
-                        new_customer['Customer']['firstName'],
-                        new_customer['Customer']['lastName']))
-                except:
-                    applogs.info("Unable to add new Lightspeed Customer for {} {}".format(
+                    applogs.info("Updating Last Sync of customer {} {}.".format(
                         vc_formatted['Customer']['firstName'],
                         vc_formatted['Customer']['lastName']))
+                return dict(action="update", person_pk=i["person_pk"], changes=changes, vc_hash=vc_hash,
+                            data=customer_update(vc_formatted["Customer"], changes, check_current["Customer"],
+                                                 lastsync_custom_id, force))
+
+            applogs.info("Record {} {} already up to date.".format(
+                vc_formatted['Customer']['firstName'],
+                vc_formatted['Customer']['lastName']))
+            with lock:
+                up_to_date.append((str(i["person_pk"]), vc_hash, check_current['Customer']['customerID']))
+            settle(i["person_pk"], "up_to_date")
+            return None
+
+        # Add new user when not found in LS
+        applogs.info("Adding new Lightspeed Customer for {} {}".format(
+            vc_formatted['Customer']['firstName'],
+            vc_formatted['Customer']['lastName']))
+        return dict(action="create", person_pk=i["person_pk"], data=vc_formatted["Customer"], vc_hash=vc_hash)
+
+    # Journal each write as soon as Lightspeed accepts it.
+    def write(job):
+        started = time.perf_counter()
+        try:
+            customer = write_ls_customer(ls, job)
+        finally:
+            ctx.metrics.add_phase("sync", "write", time.perf_counter() - started)
+        state.set_checkpoints(key, [(job["person_pk"], job["action"] + "d")])
+        # A kept index would otherwise hold the customer as it was before this write.
+        ctx.forget_customer(ls_customerTypeID, job["person_pk"])
+        return customer
+
+    # Stream VC records through compare workers into write workers, with bounded queues between them,
+    # so reads and writes overlap. Writes are throttled by the client's leaky bucket.
+    watch.start("pipeline")
+    compare_workers = int(operation_json.get("sync_compare_workers", 4))
+    workers = int(operation_json.get("sync_workers", 4))
+    applogs.info("Syncing with {} compare and {} write workers.".format(compare_workers, workers))
+    if plan_path:
+        stages = [(compare, compare_workers), (lambda job: job, 1)]
+    else:
+        stages = [(compare, compare_workers), (write, workers)]
+    try:
+        results = ratelimit.run_pipeline(iter_vc_people(vc, pulls), stages, SYNC_QUEUE_SIZE)
+    except vcclient.VeracrossError as e:
+        applogs.info("Unable to get Veracross data: {}".format(e))
+        results = None
+    except Exception:
+        # Keep what was journaled so the sync can be resumed.
+        state.set_checkpoints(key, journal)
+        state.close()
+        raise
+
+    if plan_path:
+        try:
+            if results is None:
+                applogs.info("No plan written.")
+                sys.exit(2)
+            watch.start("plan")
+            ctx.metrics.record("sync", "processed", counts["processed"])
+            deletes = []
+            if operation_json["sync_delete_missing"]:
+                missing = find_missing_customers(ls, vc, watch)
+                if missing is None:
+                    applogs.info("No plan written.")
+                    sys.exit(2)
+                deletes = [dict(action="delete", customerID=i["customerID"], firstName=i["firstName"],
+                                lastName=i["lastName"], person_pk=i["companyRegistrationNumber"])
+                           for i in missing[0]]
+            # Records that could not be compared are not in the plan, so applying it must not move the mark.
+            header = dict(plan=SYNC_PLAN_VERSION,
+                          plan_id=hashlib.sha1("{}:{}".format(key, sync_started.isoformat()).encode()).hexdigest(),
+                          sync_key=key,
+                          type=operation_json["type"],
+                          sync_started=sync_started.isoformat(),
+                          sync_incremental=bool(operation_json.get("sync_incremental")),
+                          sync_skip_unchanged=vc_hashes is not None,
+                          failed=counts["missing_households"] + counts["failed"])
+            actions = sorted((job for job, result, error in results), key=lambda job: str(job["person_pk"]))
+            try:
+                write_sync_plan(plan_path, header, actions + deletes)
+            except OSError as e:
+                applogs.info("Unable to write sync plan: {}".format(e))
+                sys.exit(2)
+        finally:
+            state.close()
+            watch.stop()
+        return
+
+    state.set_checkpoints(key, journal)
+
+    failed = None
+    if results is not None:
+        households.log_stats()
+        if vc_hashes is not None:
+            applogs.info("{} records unchanged since last sync.".format(counts["unchanged"]))
+        if counts["resumed"]:
+            applogs.info("{} records skipped, done before the sync was resumed.".format(counts["resumed"]))
+        ctx.metrics.record("sync", "processed", counts["processed"])
+        ctx.metrics.record("sync", "skipped", counts["unchanged"] + len(up_to_date))
+        ctx.metrics.record("sync", "resumed", counts["resumed"])
+
+        # Writes only count once Lightspeed has accepted them.
+        failed = log_write_results(results)
+        for job, customer, error in results:
+            if error is None:
+                ctx.metrics.record("sync", job["action"] + "d")
+                if job["action"] == "update" and not job["changes"]:
+                    ctx.metrics.record("sync", "stamped")
+        ctx.metrics.record("sync", "write_failed", len(failed))
+        ctx.metrics.record("sync", "failed", len(failed))
+        state.set_checkpoints(key, [(job["person_pk"], "failed") for job in failed])
+        state.finish_sync_run(key, len(failed) + counts["missing_households"] + counts["failed"])
+
+        # Remember what each record was synced with. Failed writes are left to be compared again.
+        watch.start("state")
+        if vc_hashes is not None:
+            for job, customer, error in results:
+                if error is None:
+                    up_to_date.append((str(job["person_pk"]), job["vc_hash"], customer["customerID"]))
+            state.set_person_hashes(up_to_date)
+
+    # Only advance the mark when everything was written, so a failed run is picked up again next time.
+    if operation_json.get("sync_incremental"):
+        if failed is None:
+            applogs.info("Unable to get Veracross data. Last sync mark not updated.")
+        elif failed or counts["missing_households"] or counts["failed"]:
+            applogs.info("{} records failed. Last sync mark not updated.".format(
+                len(failed) + counts["missing_households"] + counts["failed"]))
+        else:
+            state.set_sync_mark(key, sync_started)
+
+    state.close()
+    watch.stop()
+
+
+def write_sync_plan(filename, header, actions):
+    """
+    Write a sync plan as JSON lines, the header first and then one action per line.
+    Gzip compressed when the file name ends in .gz.
+    :param filename: Complete path of the plan
+    :param header: Plan header
+    :param actions: create, update and delete actions
+    :return: None
+    """
+    opener = gzip.open if filename.endswith(".gz") else open
+    with opener(filename + ".part", "wt") as f:
+        f.write(json.dumps(header, separators=(",", ":"), default=str) + "\n")
+        for action in actions:
+            f.write(json.dumps(action, separators=(",", ":"), default=str) + "\n")
+    os.replace(filename + ".part", filename)
+
+    counts = collections.Counter(action["action"] for action in actions)
+    applogs.info("Wrote plan {} with {} creates, {} updates and {} deletes to {}".format(
+        header["plan_id"][:12], counts["create"], counts["update"], counts["delete"], filename))
+
+
+def read_sync_plan(filename):
+    """
+    Read a plan written by write_sync_plan.
+    :param filename: Complete path of the plan
+    :return: (header, list of actions)
+    """
+    opener = gzip.open if filename.endswith(".gz") else open
+    with opener(filename, "rt") as f:
+        header = json.loads(f.readline())
+        if header.get("plan") != SYNC_PLAN_VERSION:
+            raise ValueError("{} is not a version {} sync plan.".format(filename, SYNC_PLAN_VERSION))
+        return header, [json.loads(line) for line in f if line.strip()]
+
+
+def apply_plan_action(lightspeed_connection, action):
+    """
+    Carry out one planned action. Safe to repeat after a crash: a create finds the customer an
+    earlier attempt made, and a delete of a customer already gone succeeds.
+    A delete is checked against the customer's balance again, as it may have changed since the plan
+    was made, and skipped like delete_customer does when there is a balance.
+    :param lightspeed_connection: lsclient.LightspeedClient
+    :param action: Plan action
+    :return: Customer created or updated, None for a delete, or PLAN_SKIPPED
+    """
+    if action["action"] == "delete":
+        current = None
+        for current in iter_ls_records(lightspeed_connection, "Customer",
+                                       dict(customerID=action["customerID"], load_relations='["CreditAccount"]')):
+            break
+        if current is None:
+            applogs.info("Customer {} already deleted.".format(action["customerID"]))
+            return None
+        if "CreditAccount" in current and float(current["CreditAccount"]["balance"]) > 0:
+            applogs.info("Cannot delete customer {}, {} {} with credit balance.".format(action["customerID"],
+                                                                                     action["firstName"],
+                                                                                     action["lastName"]))
+            return PLAN_SKIPPED
+
+        applogs.info("Deleting customer {} {}".format(action["firstName"], action["lastName"]))
+        if lightspeed_connection.delete("Customer/" + str(action["customerID"])) is None:
+            current = lightspeed_connection.get("Customer", parameters=dict(customerID=action["customerID"]))
+            if current is not None and "Customer" not in current:
+                return None
+            raise ValueError("Lightspeed did not delete customer {}.".format(action["customerID"]))
+        return None
+
+    if action["action"] == "create":
+        current = find_ls_customer(lightspeed_connection, action["person_pk"])
+        if current:
+            applogs.info("Customer for VC Record {} already created.".format(action["person_pk"]))
+            return current["Customer"]
+
+    return write_ls_customer(lightspeed_connection, action)
+
+
+def apply_sync_plan(config, operation_json, ctx=None):
+    """
+    Apply a sync plan to Lightspeed on concurrent workers. Each action is journaled in the state
+    database as it completes, so applying the same plan again only carries out what is left.
+    :param config: config dictionary
+    :param operation_json: operation options with sync_apply, the plan file
+    :param ctx: context.RunContext
+    :return: None
+    """
+    if ctx is None:
+        ctx = context.RunContext(config)
+    ls = ctx.ls
+    watch = ctx.metrics.stopwatch("apply")
+    watch.start("read")
+
+    try:
+        header, actions = read_sync_plan(operation_json["sync_apply"])
+    except (OSError, ValueError) as e:
+        applogs.info("Unable to read sync plan: {}".format(e))
+        sys.exit(2)
+
+    # Actions are journaled by their line in the plan.
+    state = open_state(config, operation_json)
+    plan_key = "plan:" + header["plan_id"]
+    done = state.get_checkpoints(plan_key)
+    pending = [(str(n), action) for n, action in enumerate(actions) if done.get(str(n)) != "applied"]
+    applogs.info("Applying plan {} for {}: {} of {} actions left.".format(header["plan_id"][:12], header["sync_key"],
+                                                                       len(pending), len(actions)))
+
+    def apply(item):
+        n, action = item
+        customer = apply_plan_action(ls, action)
+        state.set_checkpoints(plan_key, [(n, "applied")])
+        return customer
+
+    watch.start("write")
+    workers = int(operation_json.get("sync_workers", 4))
+    results = ratelimit.run_concurrent(apply, pending, workers)
+
+    watch.start("state")
+    failed = 0
+    synced = []
+    for (n, action), customer, error in results:
+        if error is not None:
+            failed += 1
+            applogs.info("Unable to {} Lightspeed Customer for VC Record {}: {}".format(action["action"],
+                                                                                       action["person_pk"], error))
+            continue
+        if customer is PLAN_SKIPPED:
+            ctx.metrics.record("apply", "skipped")
+            continue
+        ctx.metrics.record("apply", action["action"] + "d")
+        if customer and "vc_hash" in action:
+            synced.append((str(action["person_pk"]), action["vc_hash"], customer["customerID"]))
+    ctx.metrics.record("apply", "already_applied", len(actions) - len(pending))
+    ctx.metrics.record("apply", "failed", failed)
+    applogs.info("Apply: {} done, {} already applied, {} failed.".format(len(pending) - failed,
+                                                                         len(actions) - len(pending), failed))
+
+    if header["sync_skip_unchanged"]:
+        state.set_person_hashes(synced)
+
+    # The plan stands for a sync started when it was made. Only a fully applied plan moves the mark.
+    if header["sync_incremental"]:
+        if failed:
+            applogs.info("{} actions failed. Last sync mark not updated.".format(failed))
+        elif header.get("failed"):
+            applogs.info("{} records failed when the plan was made. Last sync mark not updated.".format(
+                header["failed"]))
+        else:
+            state.set_sync_mark(header["sync_key"], datetime.datetime.fromisoformat(header["sync_started"]))
+
+    state.close()
+    watch.stop()
+    if failed:
+        sys.exit(2)
+
+
+def iter_ls_records(lightspeed_connection, source, parameters=None):
+    """
+    Page through a Lightspeed source one record at a time.
+    :param lightspeed_connection: lsclient.LightspeedClient
+    :param source: API Source, also the record key in each page (e.g. "Sale")
+    :param parameters: Optional URL Parameters.
+    :return: Generator of records
+    """
+    key = source.split("/")[-1]
+    for page in lightspeed_connection.iter_pages(source, parameters):
+        if key not in page:
+            continue
+        if isinstance(page[key], list):
+            for record in page[key]:
+                yield record
+        else:
+            yield page[key]
 
 
 def get_payment_types(lightspeed_connection):
@@ -413,56 +1287,432 @@ def get_employees(lightspeed_connection):
 
 
 def clear_account_balances(lightspeed_connection, customerID, balance, paymentID, creditAccountID, emp_id):
-    try:
-        formatted_request = {
-                            "employeeID": emp_id,
-                            "registerID": 1,
-                            "shopID": 1,
-                            "customerID": customerID,
-                            "completed": 'true',
-                            "SaleLines": {
-                                "SaleLine": {
-                                    "itemID": 0,
-                                    "note": "Balance Cleared by LSVCConnector",
-                                    "unitQuantity": 1,
-                                    "unitPrice": -float(balance),
-                                    "taxClassID": 0,
-                                    "avgCost": 0,
-                                    "fifoCost": 0
-                                }
-                            },
-                            "SalePayments": {
-                                "SalePayment": {
-                                    "amount": -float(balance),
-                                    "paymentTypeID": paymentID,
-                                    "creditAccountID": creditAccountID
-                                }
+    """
+    Clear a customer's credit account balance with a negative Sale paid on account.
+    :return: the Sale created
+    """
+    formatted_request = {
+                        "employeeID": emp_id,
+                        "registerID": 1,
+                        "shopID": 1,
+                        "customerID": customerID,
+                        "completed": 'true',
+                        "SaleLines": {
+                            "SaleLine": {
+                                "itemID": 0,
+                                "note": "Balance Cleared by LSVCConnector",
+                                "unitQuantity": 1,
+                                "unitPrice": -float(balance),
+                                "taxClassID": 0,
+                                "avgCost": 0,
+                                "fifoCost": 0
+                            }
+                        },
+                        "SalePayments": {
+                            "SalePayment": {
+                                "amount": -float(balance),
+                                "paymentTypeID": paymentID,
+                                "creditAccountID": creditAccountID
                             }
                         }
-    except:
-        applogs.info("Unable to format data to clear balances. Data missing?")
+                    }
 
-    try:
-        lightspeed_connection.create('Sale', data=formatted_request)
-        applogs.info("Cleared balance of {} of customerID {}".format(str(balance), str(customerID)))
-    except:
+    r = lightspeed_connection.create('Sale', data=formatted_request)
+    if not r or 'Sale' not in r:
         applogs.info("Unable to clear balance for customerID {}. Request follows.".format(str(customerID)))
         applogs.info(formatted_request)
+        raise ValueError("Lightspeed did not accept the Sale.")
+
+    applogs.info("Cleared balance of {} of customerID {}".format(str(balance), str(customerID)))
+    return r['Sale']
+
+
+def write_clearing_plan(filename, clearing_plan):
+    """
+    Write the accounts about to be cleared to CSV.
+    :param filename: Complete path to the plan file
+    :param clearing_plan: list of plan entries
+    :return: None
+    """
+    f = ['customerID', 'firstName', 'lastName', 'balance', 'creditAccountID', 'paymentTypeID', 'employeeID']
+
+    with open(filename, 'w') as plan_file:
+        write = csv.DictWriter(plan_file, fieldnames=f)
+        write.writeheader()
+        write.writerows(clearing_plan)
+
+
+def clear_planned_balance(lightspeed_connection, state, plan_id, entry):
+    """
+    Clear one planned balance at most once, journaled in the state database under the plan.
+    A clear left pending by an interrupted run, of this plan or an earlier one, is resolved against
+    the balance Lightspeed shows now: a cleared account is skipped, and the planned balance is only
+    cleared if it is still the one owed.
+    :param lightspeed_connection: lsclient.LightspeedClient
+    :param state: statedb.StateDB
+    :param plan_id: Clearing plan, part of the journal key
+    :param entry: Clearing plan entry
+    :return: "cleared" or "skipped"
+    """
+    clear_key = "{}:{}".format(plan_id, entry["customerID"])
+    if state.get_clearing_status(clear_key) == "cleared":
+        return "skipped"
+
+    pending = state.get_pending_clearings(entry["customerID"])
+    if pending:
+        current = lightspeed_connection.get("Customer/" + str(entry["customerID"]),
+                                            parameters=dict(load_relations='["CreditAccount"]'))
+        if not current or "Customer" not in current:
+            raise ValueError("Unable to check balance left by interrupted clear.")
+        balance = current["Customer"].get("CreditAccount", {}).get("balance", "0")
+        if float(balance) <= 0:
+            for pending_key, pending_balance in pending:
+                state.set_clearing(pending_key, entry["customerID"], pending_balance, "cleared")
+            return "skipped"
+        if float(balance) != float(entry["balance"]):
+            raise ValueError("Balance changed from {} to {} since an interrupted clear. Check manually.".format(
+                entry["balance"], balance))
+        # The planned balance is still owed, so the interrupted clear never went through.
+        for pending_key, pending_balance in pending:
+            if pending_key != clear_key:
+                state.set_clearing(pending_key, entry["customerID"], pending_balance, "superseded")
+
+    state.set_clearing(clear_key, entry["customerID"], entry["balance"], "pending")
+    sale = clear_account_balances(lightspeed_connection,
+                                  entry["customerID"],
+                                  entry["balance"],
+                                  entry["paymentTypeID"],
+                                  entry["creditAccountID"],
+                                  entry["employeeID"])
+    state.set_clearing(clear_key, entry["customerID"], entry["balance"], "cleared", sale.get("saleID"))
+    return "cleared"
+
+
+def sale_on_account(i):
+    """
+    Does this Sale have a payment that is on account.
+    :param i: Lightspeed Sale with SalePayments.PaymentType relation
+    :return: bool
+    """
+    on_account = False
+
+    if 'SalePayments' in i:
+        if isinstance(i['SalePayments']['SalePayment'], list):
+            for p in i['SalePayments']['SalePayment']:
+                if p['PaymentType']['code'] == 'SCA':
+                    on_account = True
+        else:
+            if i['SalePayments']['SalePayment']['PaymentType']['code'] == 'SCA':
+                on_account = True
+
+    return on_account
+
+
+def iter_export_sales(lightspeed_connection, parameters, ls_customerTypeID, batch_size=100, skip_sales=None):
+    """
+    Page through the Sales to export in two passes.
+    The first pass loads only the Customer and payment types to find on account Sales of the
+    customer type. The second loads the line items for just those Sales, batch_size at a time.
+    :param lightspeed_connection: lsclient.LightspeedClient
+    :param parameters: Sale query parameters without load_relations
+    :param ls_customerTypeID: Lightspeed customerTypeID being exported
+    :param batch_size: Sales per second pass request
+    :param skip_sales: Optional set of saleID already exported, left out before their lines are loaded
+    :return: Generator of Sales with SALE_EXPORT_RELATIONS loaded
+    """
+    filter_parameters = dict(parameters)
+    filter_parameters['load_relations'] = SALE_FILTER_RELATIONS
+
+    batch = []
+    skipped = 0
+    for sale in iter_ls_records(lightspeed_connection, "Sale", filter_parameters):
+        try:
+            if sale['Customer']['customerTypeID'] != ls_customerTypeID or not sale_on_account(sale):
+                continue
+        except KeyError:
+            continue
+
+        if skip_sales and str(sale['saleID']) in skip_sales:
+            skipped += 1
+            continue
+
+        batch.append(str(sale['saleID']))
+        if len(batch) >= batch_size:
+            for sale in load_sales(lightspeed_connection, batch):
+                yield sale
+            batch = []
+
+    if batch:
+        for sale in load_sales(lightspeed_connection, batch):
+            yield sale
+
+    if skipped:
+        applogs.info("Skipped {} Sales already exported.".format(skipped))
+
+
+def load_sales(lightspeed_connection, sale_ids):
+    """
+    Get Sales by saleID with everything the export needs, in the order requested.
+    :param lightspeed_connection: lsclient.LightspeedClient
+    :param sale_ids: list of saleID
+    :return: list of Sales
+    """
+    parameters = dict(load_relations=SALE_EXPORT_RELATIONS,
+                      saleID='IN,[' + ','.join(sale_ids) + ']',
+                      limit=100)
+    sales = dict((str(sale['saleID']), sale) for sale in iter_ls_records(lightspeed_connection, "Sale", parameters))
+    return [sales[sale_id] for sale_id in sale_ids if sale_id in sales]
+
+
+def sale_timestamp_filter(begin_date, end_date, utc_offset_iso):
+    """
+    Sale timeStamp query from the start of one day to the end of another, both in the shop's UTC offset.
+    :param begin_date: YYYY-MM-DD
+    :param end_date: YYYY-MM-DD
+    :param utc_offset_iso: Shop UTC offset such as -05:00
+    :return: str
+    """
+    return '{},{}T00:00:00{},{}T23:59:59{}'.format("><", begin_date, utc_offset_iso, end_date, utc_offset_iso)
+
+
+def export_date_shards(begin_date, end_date, shard):
+    """
+    Split an export date range into consecutive shards.
+    :param begin_date: YYYY-MM-DD
+    :param end_date: YYYY-MM-DD
+    :param shard: "day" or "week"
+    :return: list of (begin_date, end_date)
+    """
+    begin = datetime.date.fromisoformat(str(begin_date))
+    end = datetime.date.fromisoformat(str(end_date))
+    days = datetime.timedelta(days=EXPORT_SHARD_DAYS[shard])
+
+    shards = []
+    while begin <= end:
+        shard_end = min(end, begin + days - datetime.timedelta(days=1))
+        shards.append((begin.isoformat(), shard_end.isoformat()))
+        begin = shard_end + datetime.timedelta(days=1)
+    return shards
+
+
+def sharded_export_rows(lightspeed_connection, parameters, begin_date, end_date, utc_offset_iso,
+                        ls_customerTypeID, shop_id, operation_json, skip_sales=None, exported=None):
+    """
+    Fetch the export in date shards on concurrent workers and stream them in date order, each shard
+    in saleID order. Only a few shards past the one being written are fetched ahead, so the export
+    is never held in memory whole.
+    Shards are whole days in the shop's UTC offset, so each one starts where the one before it ends.
+    A Sale is still only exported once if neighbouring shards both return it.
+    :param lightspeed_connection: lsclient.LightspeedClient
+    :param parameters: Sale query parameters, timeStamp is replaced per shard
+    :param begin_date: YYYY-MM-DD
+    :param end_date: YYYY-MM-DD
+    :param utc_offset_iso: Shop UTC offset such as -05:00
+    :param ls_customerTypeID: Lightspeed customerTypeID being exported
+    :param shop_id: Lightspeed shopID being exported
+    :param operation_json: export options
+    :param skip_sales: Optional set of saleID already exported
+    :param exported: Optional list to extend with the exported lines, see export_rows
+    :return: Generator of CSV rows
+    """
+    shards = export_date_shards(begin_date, end_date, operation_json["export_shard"])
+    workers = int(operation_json.get("export_workers", 4))
+    applogs.info("Exporting {} {} shards with {} workers.".format(len(shards), operation_json["export_shard"],
+                                                                 workers))
+
+    def fetch_shard(dates):
+        shard_parameters = dict(parameters)
+        shard_parameters['timeStamp'] = sale_timestamp_filter(dates[0], dates[1], utc_offset_iso)
+        lines = []
+        for i in iter_export_sales(lightspeed_connection, shard_parameters, ls_customerTypeID,
+                                   skip_sales=skip_sales):
+            lines.extend(sale_lines(i, ls_customerTypeID, shop_id))
+        lines.sort(key=lambda line: int(line[0]['saleID']))
+        return export_rows(lines, operation_json, exported)
+
+    # The last column is the saleID. The lines of a Sale already taken from the shard before are skipped.
+    previous = set()
+    for dates, rows, error in ratelimit.iter_concurrent(fetch_shard, shards, workers):
+        if error is not None:
+            applogs.info("Unable to export Sales from {} to {}.".format(dates[0], dates[1]))
+            raise error
+        current = set()
+        for row in rows:
+            if row[-1] in previous:
+                continue
+            current.add(row[-1])
+            yield row
+        previous = current
+
+
+def sale_lines(i, ls_customerTypeID, shop_id):
+    """
+    Normalize the SaleLines of one Sale to export.
+    Lightspeed returns a list for several lines and a single dictionary for one, this returns a list either way.
+    Nothing is returned for Sales not on account, for other customer types or for lines in other shops.
+    :param i: Lightspeed Sale with Customer, SaleLines and SalePayments relations
+    :param ls_customerTypeID: Lightspeed customerTypeID being exported
+    :param shop_id: Lightspeed shopID being exported
+    :return: list of (Sale, SaleLine, item date, description)
+    """
+    # Does this invoice have a payment that is on account.
+    if 'SaleLines' not in i or not sale_on_account(i):
+        return []
+
+    # Check this is a customer we requested.
+    if i['Customer']['customerTypeID'] != ls_customerTypeID:
+        return []
+
+    # Flag mixed payments with on credit account. They are still exported.
+    if isinstance(i['SalePayments']['SalePayment'], list):
+        for p in i['SalePayments']['SalePayment']:
+            if p['PaymentType']['code'] == 'SCA':
+                applogs.info("Skipping Sale #%s (%s %s): Other payments mixed with On Account." %
+                             (str(i['saleID']), str(i['Customer']['firstName']), str(i['Customer']['lastName'])))
+
+    lines = []
+    if isinstance(i['SaleLines']['SaleLine'], list):
+        for s in i['SaleLines']['SaleLine']:
+            # Ignore this entry if it was not in the shop selected.
+            if 'shopID' not in s:
+                applogs.info("Unable to determine shopID for entry: %s." % s)
+                continue
+            if s['shopID'] != shop_id:
+                continue
+            lines.append((i, s, i['timeStamp'][:10], saleline_description(s)))
+    else:
+        # A single line is only exported when it is an item, with the date of the line itself.
+        s = i['SaleLines']['SaleLine']
+        if 'Item' in s and s.get('shopID') == shop_id:
+            lines.append((i, s, s.get('timeStamp', i['timeStamp'])[:10], saleline_description(s)))
+
+    return lines
+
 
+def saleline_description(s):
+    """
+    Item description of a SaleLine, or the note of a line without an item.
+    :param s: Lightspeed SaleLine with Item and Note relations
+    :return: str
+    """
+    if 'Item' in s:
+        return str(s['Item'].get('description', "Unknown"))
+    if 'Note' in s and 'note' in s['Note']:
+        applogs.info("Debug Output: Sale line without actual item: " + str(s['Note']['note']))
+        return str(s['Note']['note'])
+    return "Unknown"
+
+
+def discard_partial_export(filename, columnar_file=None):
+    """
+    Remove the partial files a failed export leaves behind.
+    :param filename: Complete path of the export file
+    :param columnar_file: Optional writers.ColumnarWriter still open
+    :return: None
+    """
+    if os.path.exists(filename + '.part'):
+        os.remove(filename + '.part')
+    if columnar_file:
+        columnar_file.abort()
 
-def export_charge_balance(config, operation_json):
+
+def export_rows(lines, operation_json, exported=None):
+    """
+    Format the export rows of many SaleLines at once.
+    The line amounts are parsed into columns in one pass, then the derived columns are computed
+    column by column with the same Decimal arithmetic and ROUND_HALF_UP rounding as before.
+    :param lines: list of (Sale, SaleLine, item date, description) from sale_lines
+    :param operation_json: export options
+    :param exported: Optional list to extend with (saleLineID, saleID, Sale date) of each line exported
+    :return: list of CSV rows
+    """
+    kept = []
+    quantities = []
+    prices = []
+    discounts = []
+    subtotals = []
+    taxes = []
+    totals = []
+
+    for line in lines:
+        s = line[1]
+        try:
+            quantity = int(s['unitQuantity'])
+            if quantity == 0:
+                raise ValueError("unitQuantity is 0")
+            price = Decimal(s['unitPrice'])
+            discount = Decimal(s['calcLineDiscount'])
+            subtotal = Decimal(s['displayableSubtotal'])
+            tax = Decimal(s['calcTax1'])
+            total = Decimal(s['calcTotal'])
+        except (KeyError, TypeError, ValueError, ArithmeticError):
+            applogs.info("Unable to append item %s for Sale %s data to CSV." % (str(s.get('saleLineID')),
+                                                                                str(line[0]['saleID'])))
+            applogs.info("Debug Output: " + str(s))
+            continue
+        kept.append(line)
+        quantities.append(quantity)
+        prices.append(price)
+        discounts.append(discount)
+        subtotals.append(subtotal)
+        taxes.append(tax)
+        totals.append(total)
+
+    cent = Decimal(".01")
+    unit_prices = [p - (d / q) for p, d, q in zip(prices, discounts, quantities)]
+    taxes = [t.quantize(cent, rounding=ROUND_HALF_UP) for t in taxes]
+    totals = [t.quantize(cent, rounding=ROUND_HALF_UP) for t in totals]
+
+    source = operation_json["export_options_transaction_source"]
+    transaction_type = operation_json["export_options_transaction_type"]
+    school_year = operation_json["export_options_school_year"]
+    catalog_item = operation_json["export_options_catalog_item"]
+
+    rows = []
+    for (i, s, item_date, description), unit_price, subtotal, tax, total in zip(kept, unit_prices, subtotals,
+                                                                               taxes, totals):
+        person_id = str(i['Customer']['companyRegistrationNumber'])
+        rows.append([person_id,
+                     person_id,
+                     str(i['Customer']['firstName'] + " " + i['Customer']['lastName']),
+                     source,
+                     transaction_type,
+                     school_year,
+                     item_date,
+                     catalog_item,
+                     description,
+                     str(s['unitQuantity']),
+                     unit_price,
+                     subtotal,
+                     tax,
+                     total,
+                     str(i['saleID'])])
+
+    if exported is not None:
+        exported.extend((s['saleLineID'], i['saleID'], str(i.get('timeStamp', ''))[:10])
+                        for i, s, item_date, description in kept)
+    return rows
+
+
+def export_charge_balance(config, operation_json, ctx=None):
     """
     Export Charges from LS in CSV
     :return:
     """
     c = config
-    ls = lightspeed_api.Lightspeed(c)
+    if ctx is None:
+        ctx = context.RunContext(c)
+    ls = ctx.ls
+
+    watch = ctx.metrics.stopwatch("export")
+    watch.start("reference")
 
     current_store = operation_json["export_shop"]
-    ls_shops = get_shops(ls)
+    ls_shops = ctx.reference("Shop", get_shops)
 
     # Set current Timezone
     shop_timezone_name = ls_shops[current_store]["timeZone"]
+    import pytz
     timezone = pytz.timezone(shop_timezone_name)
     shop_timezone_utc_offset = datetime.datetime.now(timezone).strftime('%z')
     shop_timezone_utc_offset_iso = shop_timezone_utc_offset[:3] + ":" + shop_timezone_utc_offset[3:]
@@ -472,7 +1722,7 @@ def export_charge_balance(config, operation_json):
     # Customer Type
     ct = operation_json["type"]
     try:
-        ls_customer_types = get_ls_customer_types(ls)
+        ls_customer_types = ctx.reference("CustomerType", get_ls_customer_types)
         ls_customerTypeID = ls_customer_types[ct]
     except:
         applogs.info("Unable to assign customer type from Lightspeed")
@@ -486,11 +1736,13 @@ def export_charge_balance(config, operation_json):
     applogs.info("Filtering results to shop %s, id %s" % (shop, shop_id))
 
     # Are we clearing charges?
+    clear_charges = False
     try:
         if operation_json["export_clear_charges"]:
             pt = operation_json["export_clear_payment_type"]
-            ls_payment_types = get_payment_types(ls)
+            ls_payment_types = ctx.reference("PaymentType", get_payment_types)
             pt_id = ls_payment_types[pt]
+            clear_charges = True
     except:
         applogs.info("Not clearing charges. Missing export_clear_charges or export_clear_payment_type from json.")
 
@@ -523,21 +1775,56 @@ def export_charge_balance(config, operation_json):
         sys.exit(2)
 
     try:
-        parameters = {}
-        parameters['load_relations'] = 'all'
-        parameters['completed'] = 'true'
-        parameters['timeStamp'] = '{},{}T00:00:00-04:00,{}T23:59:59{}'.format("><",
-                                                                              begin_date,
-                                                                              end_date,
-                                                                              shop_timezone_utc_offset_iso)
-        applogs.info("Querying Lightspeed \"Sales\" data point with parameters " + str(parameters))
-        salelines = ls.get("Sale", parameters=parameters)
+        filename = operation_json["export_path"]
+        filename = (filename + '/lightspeed_salelines_export_' +
+                    datetime.datetime.now().strftime('%m%d%Y-%H%m%S') + '.csv')
+        applogs.info(str(filename))
     except:
-        salelines = None
-        applogs.info("Unable to get SaleLine data.")
+        applogs.info("Unable to determine export file.")
         sys.exit(2)
 
-    saleline_export_data = []
+    parameters = {}
+    parameters['completed'] = 'true'
+    parameters['shopID'] = shop_id
+    parameters['limit'] = 100
+    parameters['timeStamp'] = sale_timestamp_filter(begin_date, end_date, shop_timezone_utc_offset_iso)
+    applogs.info("Querying Lightspeed \"Sales\" data point with parameters " + str(parameters))
+
+    # Split long date ranges into shards fetched concurrently?
+    shard = operation_json.get("export_shard")
+    if shard and shard not in EXPORT_SHARD_DAYS:
+        applogs.info("Invalid export_shard. Must be day or week.")
+        sys.exit(2)
+
+    # Also write the exports as Parquet or Arrow IPC?
+    columnar = operation_json.get("export_columnar")
+    if columnar:
+        if columnar not in writers.COLUMNAR_FORMATS:
+            applogs.info("Invalid export_columnar. Must be parquet or arrow.")
+            sys.exit(2)
+        if not writers.pyarrow_available():
+            applogs.info("export_columnar needs the pyarrow package. Install it with pip install pyarrow.")
+            sys.exit(2)
+
+    # Delta export. The ledger of exported lines leaves out Sales an earlier run already exported,
+    # so overlapping date ranges are never billed twice.
+    delta = operation_json.get("export_delta")
+    export_key = "{}:{}".format(shop_id, ls_customerTypeID)
+    exported_sales = None
+    exported_lines = None
+    if delta:
+        exported_lines = []
+        if operation_json.get("export_reemit"):
+            applogs.info("Exporting all Sales from {} to {} again.".format(begin_date, end_date))
+        else:
+            # Sale timestamps are in the shop timezone, give a day either side.
+            state = open_state(config, operation_json)
+            exported_sales = state.get_exported_sales(
+                export_key,
+                datetime.date.fromisoformat(begin_date) - datetime.timedelta(days=1),
+                datetime.date.fromisoformat(end_date) + datetime.timedelta(days=1))
+            state.close()
+            applogs.info("{} Sales in the date range were already exported.".format(len(exported_sales)))
 
     # throw down some headers.
     f = ['person_id',
@@ -557,177 +1844,73 @@ def export_charge_balance(config, operation_json):
          'pos_transaction_id'
          ]
 
-    saleline_export_data.append(f)
-
-    for i in salelines['Sale']:
-
-        # Does this invoice have a payment that is on account.
-        on_account = False
-
-        if 'SalePayments' in i:
-            if isinstance(i['SalePayments']['SalePayment'], list):
-                for p in i['SalePayments']['SalePayment']:
-                    if p['PaymentType']['code'] == 'SCA':
-                        on_account = True
-            else:
-                if i['SalePayments']['SalePayment']['PaymentType']['code'] == 'SCA':
-                    on_account = True
-
-        if 'SaleLines' in i and on_account is True:
-
-            # Check this is a customer we requested.
-            if i['Customer']['customerTypeID'] != ls_customerTypeID:
-                continue
-
-            # Verify there are not mixed payments with on credit account
-            if isinstance(i['SalePayments']['SalePayment'], list):
-                for p in i['SalePayments']['SalePayment']:
-                    if p['PaymentType']['code'] == 'SCA':
-                        # Skip sales that mix payments with on_account
-                        applogs.info("Skipping Sale #%s (%s %s): Other payments mixed with On Account." %
-                                              (str(i['saleID']),
-                                               str(i['Customer']['firstName']),
-                                               str(i['Customer']['lastName'])))
-                        continue
-
-            # Depending on how many items sold,
-            # types of salelines are returned.
-            # List of dictionaries and a single dictionary.
-            # Is this multiline sale?
-            if isinstance(i['SaleLines']['SaleLine'], list):
-
-                for s in i['SaleLines']['SaleLine']:
-
-                    # Ignore this entry if it was not in the shop selected.
-                    try:
-                        if s['shopID'] != shop_id:
-                            # applogs.info("ShopID for entry is not the shop that was requested, "
-                            #                      "skipping entry: %s" % str(s))
-                            continue
-                    except:
-                        applogs.info("Unable to determine shopID for entry: %s." % s)
-                        continue
-
-                    # Determine correct item description to use:
-                    try:
-                        if 'Item' in s:
-                            if 'description' in s['Item']:
-                                description = str(s['Item']['description'])
-                            else:
-                                description = "Unknown"
-                        elif 'Note' in s:
-                            if 'note' in s['Note']:
-                                description = str(s['Note']['note'])
-                                applogs.info("Debug Output: Sale line without actual item: " +
-                                                      str(description))
-                        else:
-                            description = "Unknown"
-                    except:
-                        description = "Unknown"
-
-                    # Format the entry to be added to our export file.
-                    try:
-
-                        saleline_single = [str(i['Customer']['companyRegistrationNumber']),
-                                           str(i['Customer']['companyRegistrationNumber']),
-                                           str(i['Customer']['firstName'] + " " + i['Customer']['lastName']),
-                                           operation_json["export_options_transaction_source"],
-                                           operation_json["export_options_transaction_type"],
-                                           operation_json["export_options_school_year"],
-                                           str(i['timeStamp'][:10]),
-                                           operation_json["export_options_catalog_item"],
-                                           str(description),
-                                           str(s['unitQuantity']),
-                                           Decimal(s['unitPrice']) -
-                                           (Decimal(s['calcLineDiscount']) / int(s['unitQuantity'])),
-                                           Decimal(s['displayableSubtotal']),
-                                           roundup_decimal(Decimal(s['calcTax1'])),
-                                           roundup_decimal(Decimal(s['calcTotal'])),
-                                           str(i['saleID'])
-                                           ]
-
-                        saleline_export_data.append(saleline_single)
-                    except:
-                        applogs.info("Unable to append item (multisale) %s for Sale %s data to CSV." %
-                                              (str(s['saleLineID']), str(i['saleID'])))
-                        applogs.info("Debug Output: " + str(s))
-            else:
-                try:
-                    # Is this a singleline sale?
-                    if 'Item' in i["SaleLines"]["SaleLine"]:
-                        # Need to be able to identify the item by it's type and not if it has items.
-                        # What if only single misc charge?  To do this the way we clear balances needs to be change.
-                        # Ideally we would want a Payment to CC Account.
-                        # if isinstance(i["SaleLines"]["SaleLine"], dict):
-                        # Ignore this entry if it was not in the shop selected.
-                        if i["SaleLines"]["SaleLine"]["shopID"] != shop_id:
-                            #applogs.info("ShopID for entry is not the shop that was requested, "
-                            #                      "skipping entry: %s" % str(i["SaleLines"]["SaleLine"]))
-                            continue
-
-                        # Determine a description
-                        try:
-                            if 'Item' in i["SaleLines"]["SaleLine"]:
-                                if 'description' in i["SaleLines"]["SaleLine"]['Item']:
-                                    description = str(i["SaleLines"]["SaleLine"]['Item']['description'])
-                                else:
-                                    description = "Unknown"
-                            elif 'Note' in i["SaleLines"]["SaleLine"]:
-                                if 'note' in i["SaleLines"]["SaleLine"]['Note']:
-                                    description = str(i["SaleLines"]["SaleLine"]['Note']['note'])
-                                    applogs.info("Debug Output: Sale line without actual item: " +
-                                                          str(description))
-                            else:
-                                description = "Unknown"
-                        except:
-                            description = "Unknown"
-
-                        # Format the entry to be added to our export file.
-                        saleline_single = [str(i['Customer']['companyRegistrationNumber']),
-                                           str(i['Customer']['companyRegistrationNumber']),
-                                           str(i['Customer']['firstName'] + " " + i['Customer']['lastName']),
-                                           operation_json["export_options_transaction_source"],
-                                           operation_json["export_options_transaction_type"],
-                                           operation_json["export_options_school_year"],
-                                           str(i["SaleLines"]["SaleLine"]['timeStamp'][:10]),
-                                           operation_json["export_options_catalog_item"],
-                                           str(description),
-                                           str(i["SaleLines"]["SaleLine"]['unitQuantity']),
-                                           Decimal(i["SaleLines"]["SaleLine"]['unitPrice']) -
-                                           (Decimal(i["SaleLines"]["SaleLine"]['calcLineDiscount']) /
-                                            int(i["SaleLines"]["SaleLine"]['unitQuantity'])),
-                                           Decimal(i["SaleLines"]["SaleLine"]['displayableSubtotal']),
-                                           roundup_decimal(
-                                               Decimal(i["SaleLines"]["SaleLine"]['calcTax1'])),
-                                           roundup_decimal(
-                                               Decimal(i["SaleLines"]["SaleLine"]['calcTotal'])),
-                                           str(i['saleID'])
-                                           ]
-
-                        saleline_export_data.append(saleline_single)
-                except:
-                    applogs.info("Unable to append (single) saleline for sale # " + str(i['saleID']),
-                                          "info")
-                    applogs.info("Debug Output: " + str(i["SaleLines"]["SaleLine"]))
-
+    # Page through the Sales and write rows as they arrive, so memory stays flat however long
+    # the date range. Written to a partial file that only takes the real name once complete.
+    watch.start("sales")
+    exported = 0
+    columnar_file = None
     try:
-        filename = operation_json["export_path"]
-        filename = (filename + '/lightspeed_salelines_export_' +
-                    datetime.datetime.now().strftime('%m%d%Y-%H%m%S') + '.csv')
-        applogs.info(str(filename))
-    except:
-        applogs.info("Unable to determine export file.")
+        if columnar:
+            columnar_file = writers.ColumnarWriter(os.path.splitext(filename)[0] + writers.COLUMNAR_FORMATS[columnar],
+                                                   columnar, f, writers.SALELINE_TYPES)
+
+        with open(filename + '.part', 'w', buffering=EXPORT_WRITE_BUFFER) as export_file:
+            write = csv.writer(export_file)
+            write.writerow(f)
+
+            def write_rows(rows):
+                write.writerows(rows)
+                if columnar_file:
+                    columnar_file.write_rows(rows)
+                return len(rows)
+
+            if shard:
+                rows = []
+                for row in sharded_export_rows(ls, parameters, begin_date, end_date, shop_timezone_utc_offset_iso,
+                                               ls_customerTypeID, shop_id, operation_json,
+                                               exported_sales, exported_lines):
+                    rows.append(row)
+                    if len(rows) >= EXPORT_BATCH_LINES:
+                        exported += write_rows(rows)
+                        rows = []
+                exported += write_rows(rows)
+            else:
+                # Format the lines of several Sales at once.
+                lines = []
+                for i in iter_export_sales(ls, parameters, ls_customerTypeID, skip_sales=exported_sales):
+                    lines.extend(sale_lines(i, ls_customerTypeID, shop_id))
+                    if len(lines) >= EXPORT_BATCH_LINES:
+                        exported += write_rows(export_rows(lines, operation_json, exported_lines))
+                        lines = []
+                exported += write_rows(export_rows(lines, operation_json, exported_lines))
+        os.replace(filename + '.part', filename)
+        if columnar_file:
+            columnar_file.close()
+            applogs.info("Wrote {} as {}.".format(columnar_file.filename, columnar))
+        ctx.metrics.record("export", "sale_lines", exported)
+    except lsclient.LightspeedError:
+        applogs.info("Unable to get SaleLine data.")
+        discard_partial_export(filename, columnar_file)
         sys.exit(2)
-
-    try:
-        with open(filename, 'w') as f:
-            write = csv.writer(f)
-            write.writerows(saleline_export_data)
     except:
         applogs.info("Unable to export salelines file.")
+        discard_partial_export(filename, columnar_file)
         sys.exit(2)
 
+    # Only record the lines once the file is in place.
+    if delta:
+        try:
+            state = open_state(config, operation_json)
+            state.add_exported_lines(export_key, exported_lines)
+            state.close()
+            applogs.info("Recorded {} exported lines in the ledger.".format(exported))
+        except:
+            applogs.info("Unable to record exported lines. {} will be exported again by the next run.".format(
+                filename))
+            sys.exit(2)
+
     # !! Account Balance Export !!
+    watch.start("balances")
     try:
         # Get Customers with Balance on account. Used to export balances and clear accounts.
         customers = ls.get("Customer", parameters=dict(load_relations='["CreditAccount"]'))
@@ -749,13 +1932,16 @@ def export_charge_balance(config, operation_json):
 
         # If we are clearing - who is it marked as?
         try:
-            emp = get_employees(ls)
+            emp = ctx.reference("Employee", get_employees)
             emp_id = emp[operation_json["export_clear_charges_employee_name"]]
 
         except:
             applogs.info("Couldn't determine charge clearing employee name. Using ID 1.")
             emp_id = 1
 
+        # Accounts to clear, built in full before anything is cleared.
+        clearing_plan = []
+
         for i in customers['Customer']:
             if 'CreditAccount' in i:
                 if (float(i['CreditAccount']['balance']) > 0) and (int(i['customerTypeID']) == int(ls_customerTypeID)):
@@ -767,31 +1953,218 @@ def export_charge_balance(config, operation_json):
                          i['customerID']]
                     export_data.append(a)
 
-                    if operation_json["export_clear_charges"]:
-
-                        # Clear the balance for this account
-                        clear_account_balances(int(i['customerID']),
-                                               float(i['CreditAccount']['balance']),
-                                               int(pt_id),
-                                               int(i["creditAccountID"]),
-                                               int(emp_id))
+                    if clear_charges:
+                        clearing_plan.append(dict(customerID=int(i['customerID']),
+                                                  firstName=i['firstName'],
+                                                  lastName=i['lastName'],
+                                                  balance=i['CreditAccount']['balance'],
+                                                  creditAccountID=int(i['creditAccountID']),
+                                                  paymentTypeID=int(pt_id),
+                                                  employeeID=int(emp_id)))
 
     except:
         applogs.info("Failed to format CreditBalance Export data.")
         sys.exit(2)
 
+    balance_file = None
     try:
         filename = operation_json["export_path"]
         filename = filename + '/lightspeed_balance_export_' + \
                    datetime.datetime.now().strftime('%m%d%Y-%H%m%S') + '.xlsx'
 
-        with open(filename, 'w') as f:
-            write = csv.writer(f)
-            write.writerows(export_data)
+        writers.write_xlsx(filename, export_data, writers.BALANCE_TYPES, sheet_name="Balances")
+
+        if columnar:
+            balance_file = writers.ColumnarWriter(os.path.splitext(filename)[0] + writers.COLUMNAR_FORMATS[columnar],
+                                                  columnar, export_data[0], writers.BALANCE_TYPES)
+            balance_file.write_rows(export_data[1:])
+            balance_file.close()
+            balance_file = None
+        ctx.metrics.record("export", "balances", len(export_data) - 1)
 
     except:
-        applogs.info("Failed to export csv balance data.")
+        applogs.info("Failed to export balance data.")
+        discard_partial_export(filename, balance_file)
+        sys.exit(2)
+
+    # !! Clear Account Balances !!
+    watch.start("clearing")
+    if clear_charges:
+        try:
+            filename = operation_json["export_path"]
+            filename = filename + '/lightspeed_clearing_plan_' + \
+                       datetime.datetime.now().strftime('%m%d%Y-%H%m%S') + '.csv'
+            write_clearing_plan(filename, clearing_plan)
+            applogs.info("Wrote plan to clear {} accounts to {}".format(len(clearing_plan), filename))
+        except:
+            applogs.info("Failed to write balance clearing plan.")
+            sys.exit(2)
+
+        if operation_json.get("export_clear_dry_run"):
+            applogs.info("Dry run. No balances cleared.")
+        else:
+            state = open_state(config, operation_json)
+            plan_id = hashlib.sha1("{}:{}:{}".format(begin_date, end_date,
+                                                     datetime.datetime.now().isoformat()).encode()).hexdigest()
+            workers = int(operation_json.get("export_clear_workers", 4))
+            results = ratelimit.run_concurrent(lambda entry: clear_planned_balance(ls, state, plan_id, entry),
+                                               clearing_plan, workers)
+            state.close()
+
+            counts = {"cleared": 0, "skipped": 0, "failed": 0}
+            for entry, outcome, error in results:
+                if error is None:
+                    counts[outcome] += 1
+                else:
+                    counts["failed"] += 1
+                    applogs.info("Unable to clear balance for customerID {}: {}".format(entry["customerID"], error))
+            applogs.info("Balance clearing: {} cleared, {} already cleared, {} failed.".format(counts["cleared"],
+                                                                                          counts["skipped"],
+                                                                                          counts["failed"]))
+            ctx.metrics.record("export", "cleared", counts["cleared"])
+            ctx.metrics.record("export", "already_cleared", counts["skipped"])
+            ctx.metrics.record("export", "clear_failed", counts["failed"])
+    watch.stop()
+
+
+def job_files(path):
+    """
+    Operation JSON files to run for an --operation_json switch.
+    :param path: JSON file or directory of JSON files
+    :return: list of file paths
+    """
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(".json"))
+    return [path]
+
+
+def run_job(config, operation, operation_json, ctx):
+    """
+    Run one sync or export operation.
+    :param config: config dictionary
+    :param operation: "sync" or "export"
+    :param operation_json: operation options
+    :param ctx: context.RunContext shared by all jobs
+    :return: exit status, 0 on success
+    """
+    try:
+        if operation == "sync" and operation_json.get("sync_apply"):
+            apply_sync_plan(config, operation_json, ctx)
+        elif operation == "sync":
+            sync_ls_vc(config, operation_json, ctx)
+            # A plan holds the deletes too.
+            if operation_json["sync_delete_missing"] and not operation_json.get("sync_plan"):
+                delete_customer(config, operation_json, ctx)
+        elif operation == "export":
+            export_charge_balance(config, operation_json, ctx)
+        else:
+            applogs.info("Unknown operation {}. Use sync or export.".format(operation))
+            return 2
+    except SystemExit as e:
+        if e.code is None:
+            return 0
+        if isinstance(e.code, int):
+            return e.code
+        return 2
+    except Exception as e:
+        applogs.info("Operation {} failed: {}".format(operation, repr(e)))
+        return 2
+
+    return 0
+
+
+def run_jobs(config, jobs, ctx, workers=1):
+    """
+    Run several jobs in one process, sharing connections and reference tables.
+    :param config: config dictionary
+    :param jobs: list of (name, operation, operation_json)
+    :param ctx: context.RunContext
+    :param workers: Number of jobs to run at once
+    :return: 0 if every job succeeded, otherwise 2
+    """
+    def run(job):
+        name, operation, operation_json = job
+        applogs.info("Starting {} job {}.".format(operation, name))
+        status = run_job(config, operation, operation_json, ctx)
+        applogs.info("Finished {} job {} with status {}.".format(operation, name, status))
+        return status
+
+    results = ratelimit.run_concurrent(run, jobs, workers)
+
+    failed = [job[0] for job, status, error in results if error is not None or status != 0]
+    if len(jobs) > 1:
+        applogs.info("{} of {} jobs succeeded.".format(len(jobs) - len(failed), len(jobs)))
+    if failed:
+        applogs.info("Failed jobs: " + ", ".join(failed))
+        return 2
+    return 0
+
+
+def write_metrics(run_metrics, operation_json):
+    """
+    Log a summary of the run's timings and API calls, and write them out if asked to.
+    :param run_metrics: metrics.Metrics of the run
+    :param operation_json: operation options with optional metrics_path and metrics_prom
+    :return: None
+    """
+    run_metrics.log_summary()
+    try:
+        if operation_json.get("metrics_path"):
+            run_metrics.write_json(operation_json["metrics_path"])
+        if operation_json.get("metrics_prom"):
+            run_metrics.write_prometheus(operation_json["metrics_prom"])
+    except OSError as e:
+        applogs.info("Unable to write metrics: {}".format(e))
+
+
+def serve_jobs(jobs):
+    """
+    Turn the jobs into the syncs serve mode repeats: incremental, with the customer index prefetched
+    and kept between runs unless the JSON says otherwise. Exports, plans and applies are not repeated.
+    :param jobs: list of (name, operation, operation_json)
+    :return: list of (name, "sync", operation_json)
+    """
+    syncs = []
+    for name, operation, operation_json in jobs:
+        if operation not in ("serve", "sync"):
+            applogs.info("Serve mode only runs syncs. Ignoring {} job {}.".format(operation, name))
+            continue
+        if operation_json.get("sync_plan") or operation_json.get("sync_apply"):
+            applogs.info("Serve mode does not plan or apply. Ignoring job {}.".format(name))
+            continue
+        operation_json.setdefault("sync_incremental", True)
+        operation_json.setdefault("sync_prefetch", True)
+        syncs.append((name, "sync", operation_json))
+
+    if not syncs:
+        applogs.info("No sync jobs to serve.")
         sys.exit(2)
+    return syncs
+
+
+def serve_jobs_forever(config, jobs, ctx, workers, serve_json):
+    """
+    Run the jobs every serve_interval seconds until stopped, writing metrics after each run.
+    :param config: config dictionary
+    :param jobs: list of (name, "sync", operation_json)
+    :param ctx: context.RunContext kept between runs
+    :param workers: Number of jobs to run at once
+    :param serve_json: operation options with the serve_* and metrics settings
+    :return: exit status of the last run
+    """
+    import serve
+
+    def run():
+        status = run_jobs(config, jobs, ctx, workers)
+        write_metrics(ctx.metrics, serve_json)
+        return status
+
+    server = serve.Server(ctx, run,
+                          interval=int(serve_json.get("serve_interval", 300)),
+                          refresh_interval=int(serve_json.get("serve_refresh_interval", 900)),
+                          host=serve_json.get("serve_host", "127.0.0.1"),
+                          port=int(serve_json.get("serve_port", 9470)))
+    return server.serve_forever()
 
 
 def main(argv):
@@ -805,6 +2178,13 @@ def main(argv):
             "grade_level": ""
         }
     }
+    config = None
+    operation_json_files = []
+    job_workers = 1
+
+    # Switches override every operation JSON, whatever order they are given in.
+    switches = dict()
+    filter_switches = dict()
 
     try:
         opts, args = getopt.getopt(argv, "vhoc:j:t:fda:g:l:", [
@@ -813,9 +2193,24 @@ def main(argv):
             "operation=",
             "config=",
             "operation_json=",
+            "job_workers=",
+            "serve_interval=",
+            "serve_port=",
             "type=",
             "sync_force",
             "sync_delete",
+            "sync_prefetch",
+            "sync_incremental",
+            "sync_skip_unchanged",
+            "resume",
+            "plan=",
+            "apply=",
+            "export_delta",
+            "export_reemit",
+            "state_path=",
+            "cache_path=",
+            "metrics_path=",
+            "metrics_prom=",
             "filter_after_date=",
             "filter_grade_level=",
             "log_path="])
@@ -835,28 +2230,60 @@ def main(argv):
                 operation = "sync"
             elif arg == "export":
                 operation = "export"
+            elif arg == "serve":
+                operation = "serve"
             else:
-                print("Unknown operation. Use sync or export.")
+                print("Unknown operation. Use sync, export or serve.")
                 sys.exit()
         elif opt in ("-c", "--config"):
             config = load_json(arg)
         elif opt in ("-j", "--operation_json"):
-            operation_json = load_json(arg)
+            operation_json_files.extend(job_files(arg))
+        elif opt == "--job_workers":
+            job_workers = int(arg)
+        elif opt == "--serve_interval":
+            switches["serve_interval"] = int(arg)
+        elif opt == "--serve_port":
+            switches["serve_port"] = int(arg)
         elif opt in ("-t", "--type"):
-            operation_json["type"] = arg
+            switches["type"] = arg
         elif opt in ("-f", "--sync_force"):
-            operation_json["sync_force"] = True
+            switches["sync_force"] = True
         elif opt in ("-d", "--sync_delete"):
-            operation_json["sync_delete_missing"] = True
+            switches["sync_delete_missing"] = True
+        elif opt == "--sync_prefetch":
+            switches["sync_prefetch"] = True
+        elif opt == "--sync_incremental":
+            switches["sync_incremental"] = True
+        elif opt == "--sync_skip_unchanged":
+            switches["sync_skip_unchanged"] = True
+        elif opt == "--resume":
+            switches["sync_resume"] = True
+        elif opt == "--plan":
+            switches["sync_plan"] = arg
+        elif opt == "--apply":
+            switches["sync_apply"] = arg
+        elif opt == "--export_delta":
+            switches["export_delta"] = True
+        elif opt == "--export_reemit":
+            switches["export_reemit"] = True
+        elif opt == "--state_path":
+            switches["state_path"] = arg
+        elif opt == "--cache_path":
+            switches["cache_path"] = arg
+        elif opt == "--metrics_path":
+            switches["metrics_path"] = arg
+        elif opt == "--metrics_prom":
+            switches["metrics_prom"] = arg
         elif opt in ("-a", "--filter_after_date"):
-            operation_json["sync_filters"]["after_date"] = arg
+            filter_switches["after_date"] = arg
         elif opt in ("-g", "--filter_grade_level"):
-            operation_json["sync_filters"]["grade_level"] = arg
+            filter_switches["grade_level"] = arg
         elif opt in ("-l", "--log_path"):
-            operation_json["log_path"] = arg
+            switches["log_path"] = arg
             try:
                 # File Log
-                logfile = logging.FileHandler(operation_json["log_path"])
+                logfile = logging.FileHandler(arg)
                 fileformat = logging.Formatter("%(asctime)s:%(levelname)s:%(message)s")
                 logfile.setLevel(logging.INFO)
                 logfile.setFormatter(fileformat)
@@ -865,14 +2292,42 @@ def main(argv):
                 print("Exception occurred while creating log file.")
                 sys.exit(2)
 
+    # One job per operation JSON, or one job from the switches alone.
+    jobs = []
+    if operation_json_files:
+        for f in operation_json_files:
+            jobs.append((os.path.basename(f), load_json(f)))
+    else:
+        jobs.append(("command line", operation_json))
+
+    for name, job_json in jobs:
+        job_json.update(switches)
+        if filter_switches:
+            job_json.setdefault("sync_filters", dict()).update(filter_switches)
+        job_json.setdefault("sync_delete_missing", False)
+
+    # Each JSON may name its own operation. The --operation switch is the default.
+    jobs = [(name, job_json.get("operation", operation), job_json) for name, job_json in jobs]
+
+    if operation == "serve":
+        jobs = serve_jobs(jobs)
+
     # Sync if there is a config
     if config:
-        if operation == "sync":
-            sync_ls_vc(config, operation_json)
-            if operation_json["sync_delete_missing"]:
-                delete_customer(config)
-        if operation == "export":
-            export_charge_balance(config, operation_json)
+        # One set of connections and reference tables for every job of the run.
+        cache_json = jobs[0][2]
+        ctx = context.RunContext(config,
+                                 cache_path=cache_json.get("cache_path"),
+                                 cache_ttl=int(cache_json.get("cache_ttl", 3600)),
+                                 keep_indexes=operation == "serve",
+                                 timeout=float(cache_json.get("api_timeout", 60)))
+        if operation == "serve":
+            status = serve_jobs_forever(config, jobs, ctx, job_workers, cache_json)
+        else:
+            status = run_jobs(config, jobs, ctx, job_workers)
+            write_metrics(ctx.metrics, cache_json)
+        if status:
+            sys.exit(status)
     else:
         applogs.info("Parameter config missing.")
         sys.exit(2)
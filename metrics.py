@@ -0,0 +1,272 @@
+"""
+Timing and API call metrics for a run.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+applogs = logging.getLogger("lsvcconnector")
+
+# Upper bounds in seconds of the API latency histogram buckets, as in a Prometheus histogram.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def endpoint(api_url, url):
+    """
+    Name the endpoint of a request url, with ids replaced so calls to the same endpoint add up.
+    e.g. https://api.lightspeedapp.com/API/V3/Account/1/Customer/12.json?x=1 is Customer/:id
+    :param api_url: Base url of the API
+    :param url: Complete request url
+    :return: str
+    """
+    path = url.split("?")[0]
+    if api_url and path.startswith(api_url):
+        path = path[len(api_url):]
+    if path.endswith(".json"):
+        path = path[:-len(".json")]
+    return "/".join(":id" if part.isdigit() else part for part in path.strip("/").split("/"))
+
+
+class Stopwatch(object):
+    """
+    Times consecutive phases of one operation. Starting a phase ends the one before it.
+    """
+
+    def __init__(self, metrics, operation):
+        self.metrics = metrics
+        self.operation = operation
+        self.phase = None
+        self.started = None
+
+    def start(self, phase):
+        self.stop()
+        self.phase = phase
+        self.started = time.perf_counter()
+
+    def stop(self):
+        if self.phase is not None:
+            self.metrics.add_phase(self.operation, self.phase, time.perf_counter() - self.started)
+            self.phase = None
+
+
+class Metrics(object):
+    """
+    Thread safe collection of phase timings, API calls per endpoint, retries, rate limit sleeps and
+    records processed. Written at the end of a run as a JSON summary and/or a Prometheus textfile.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.phases = dict()
+        self.calls = dict()
+        self.statuses = dict()
+        self.sleeps = dict()
+        self.records = dict()
+
+    def __repr__(self):
+        return "Metrics for run started " + time.ctime(self.started_at)
+
+    def stopwatch(self, operation):
+        return Stopwatch(self, operation)
+
+    def add_phase(self, operation, phase, seconds):
+        with self.lock:
+            p = self.phases.setdefault((operation, phase), dict(count=0, seconds=0.0))
+            p["count"] += 1
+            p["seconds"] += seconds
+
+    def _call(self, service, method, endpoint_name):
+        # Caller holds the lock.
+        return self.calls.setdefault((service, method.upper(), endpoint_name),
+                                     dict(calls=0, errors=0, retries=0, bytes=0, seconds=0.0,
+                                          buckets=[0] * len(LATENCY_BUCKETS)))
+
+    def api_call(self, service, method, endpoint_name, status, seconds, size=0):
+        """
+        Record one HTTP request.
+        :param service: "lightspeed" or "veracross"
+        :param method: HTTP method
+        :param endpoint_name: See endpoint()
+        :param status: HTTP status code, or "error" when no response came back
+        :param seconds: Latency
+        :param size: Bytes received
+        :return: None
+        """
+        with self.lock:
+            c = self._call(service, method, endpoint_name)
+            c["calls"] += 1
+            c["bytes"] += size
+            c["seconds"] += seconds
+            if status == "error" or status >= 400:
+                c["errors"] += 1
+            for n, le in enumerate(LATENCY_BUCKETS):
+                if seconds <= le:
+                    c["buckets"][n] += 1
+                    break
+            key = (service, method.upper(), endpoint_name, str(status))
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+
+    def retry(self, service, method, endpoint_name):
+        with self.lock:
+            self._call(service, method, endpoint_name)["retries"] += 1
+
+    def rate_limit_sleep(self, service, seconds):
+        if seconds <= 0:
+            return
+        with self.lock:
+            self.sleeps[service] = self.sleeps.get(service, 0.0) + seconds
+
+    def record(self, operation, outcome, count=1):
+        """
+        Count records by outcome, e.g. record("sync", "updated").
+        :param operation: sync, delete or export
+        :param outcome: processed, created, updated, skipped, failed...
+        :param count: Number of records
+        :return: None
+        """
+        with self.lock:
+            self.records[(operation, outcome)] = self.records.get((operation, outcome), 0) + count
+
+    def instrument_session(self, service, session, api_url):
+        """
+        Record every GET sent through a requests session. Used for Veracross, whose client
+        sends its requests itself.
+        :param service: Service name
+        :param session: requests.Session
+        :param api_url: Base url of the API
+        :return: None
+        """
+        get = session.get
+
+        def timed_get(url, **kwargs):
+            started = time.perf_counter()
+            try:
+                r = get(url, **kwargs)
+            except Exception:
+                self.api_call(service, "get", endpoint(api_url, url), "error", time.perf_counter() - started)
+                raise
+            self.api_call(service, "get", endpoint(api_url, url), r.status_code,
+                          time.perf_counter() - started, len(r.content or b""))
+            return r
+
+        session.get = timed_get
+
+    def summary(self):
+        """
+        :return: JSON serialisable dictionary of everything recorded so far
+        """
+        with self.lock:
+            return dict(
+                started_at=self.started_at,
+                duration_seconds=round(time.perf_counter() - self.started, 3),
+                phases={"{}.{}".format(o, p): dict(count=v["count"], seconds=round(v["seconds"], 3))
+                        for (o, p), v in sorted(self.phases.items())},
+                api=[dict(service=s, method=m, endpoint=e, calls=v["calls"], errors=v["errors"],
+                          retries=v["retries"], bytes=v["bytes"], seconds=round(v["seconds"], 3),
+                          latency_buckets=dict(zip([str(le) for le in LATENCY_BUCKETS] + ["+Inf"],
+                                                   self.cumulative(v))))
+                     for (s, m, e), v in sorted(self.calls.items())],
+                statuses=[dict(service=s, method=m, endpoint=e, status=st, calls=n)
+                          for (s, m, e, st), n in sorted(self.statuses.items())],
+                rate_limit_sleep_seconds={s: round(v, 3) for s, v in sorted(self.sleeps.items())},
+                records={"{}.{}".format(o, r): n for (o, r), n in sorted(self.records.items())})
+
+    @staticmethod
+    def cumulative(call):
+        counts = []
+        total = 0
+        for n in call["buckets"]:
+            total += n
+            counts.append(total)
+        counts.append(call["calls"])
+        return counts
+
+    def log_summary(self):
+        s = self.summary()
+        for name, p in s["phases"].items():
+            applogs.info("Phase {}: {:.2f}s".format(name, p["seconds"]))
+        for service in ("lightspeed", "veracross"):
+            calls = [c for c in s["api"] if c["service"] == service]
+            if calls:
+                applogs.info("{} API: {} calls, {} errors, {} retries, {:.2f}s, {:.2f}s rate limited.".format(
+                    service.capitalize(), sum(c["calls"] for c in calls), sum(c["errors"] for c in calls),
+                    sum(c["retries"] for c in calls), sum(c["seconds"] for c in calls),
+                    s["rate_limit_sleep_seconds"].get(service, 0.0)))
+        if s["records"]:
+            applogs.info("Records: " + ", ".join("{} {}".format(n, name) for name, n in s["records"].items()))
+
+    def write_json(self, path):
+        write_atomic(path, json.dumps(self.summary(), indent=2))
+
+    def write_prometheus(self, path):
+        """
+        Write a textfile for the node_exporter textfile collector.
+        :param path: Complete path of the .prom file
+        :return: None
+        """
+        write_atomic(path, self.prometheus_text())
+
+    def prometheus_text(self):
+        """
+        :return: Everything recorded so far in the Prometheus text format
+        """
+        s = self.summary()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append("# HELP lsvcconnector_{} {}".format(name, help_text))
+            lines.append("# TYPE lsvcconnector_{} {}".format(name, kind))
+            for suffix, labels, value in samples:
+                label_text = ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels)
+                if label_text:
+                    label_text = "{" + label_text + "}"
+                lines.append("lsvcconnector_{}{}{} {}".format(name, suffix, label_text, value))
+
+        metric("run_start_timestamp_seconds", "gauge", "Start time of the run.",
+               [("", [], s["started_at"])])
+        metric("run_duration_seconds", "gauge", "Wall clock time of the run.",
+               [("", [], s["duration_seconds"])])
+        metric("phase_duration_seconds", "gauge", "Time spent in each phase of an operation.",
+               [("", [("operation", k.split(".")[0]), ("phase", k.split(".", 1)[1])], v["seconds"])
+                for k, v in s["phases"].items()])
+        metric("api_requests_total", "counter", "API requests by endpoint and status.",
+               [("", [("service", c["service"]), ("method", c["method"]), ("endpoint", c["endpoint"]),
+                      ("status", c["status"])], c["calls"]) for c in s["statuses"]])
+        metric("api_retries_total", "counter", "API requests retried.",
+               [("", [("service", c["service"]), ("method", c["method"]), ("endpoint", c["endpoint"])],
+                 c["retries"]) for c in s["api"]])
+        metric("api_response_bytes_total", "counter", "Bytes received from the API.",
+               [("", [("service", c["service"]), ("method", c["method"]), ("endpoint", c["endpoint"])],
+                 c["bytes"]) for c in s["api"]])
+
+        samples = []
+        for c in s["api"]:
+            labels = [("service", c["service"]), ("method", c["method"]), ("endpoint", c["endpoint"])]
+            for le, count in c["latency_buckets"].items():
+                samples.append(("_bucket", labels + [("le", le)], count))
+            samples.append(("_sum", labels, c["seconds"]))
+            samples.append(("_count", labels, c["calls"]))
+        metric("api_request_duration_seconds", "histogram", "API request latency.", samples)
+
+        metric("rate_limit_sleep_seconds_total", "counter", "Time spent waiting on API rate limits.",
+               [("", [("service", k)], v) for k, v in s["rate_limit_sleep_seconds"].items()])
+        metric("records_total", "counter", "Records processed by outcome.",
+               [("", [("operation", k.split(".")[0]), ("outcome", k.split(".", 1)[1])], v)
+                for k, v in s["records"].items()])
+
+        return "\n".join(lines) + "\n"
+
+
+def write_atomic(path, text):
+    """
+    Write a file under a temporary name and move it into place, so readers never see half of it.
+    """
+    if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path + ".tmp", "w") as f:
+        f.write(text)
+    os.replace(path + ".tmp", path)
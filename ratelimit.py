@@ -0,0 +1,273 @@
+"""
+Rate limiting and concurrent execution helpers for the Lightspeed and Veracross APIs.
+"""
+import collections
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Marks the end of the items on a pipeline queue.
+END = object()
+
+# Units charged by Lightspeed for each request method.
+READ_UNITS = 1
+WRITE_UNITS = 10
+
+
+class LeakyBucket(object):
+    """
+    Client side copy of the Lightspeed leaky bucket shared by all worker threads.
+    Lightspeed reports the bucket as X-LS-API-Bucket-Level ("used/size") and
+    X-LS-API-Drip-Rate (units drained per second).
+    """
+
+    def __init__(self, size=60, drip_rate=1):
+        self.lock = threading.Lock()
+        self.size = float(size)
+        self.drip_rate = float(drip_rate)
+        self.level = 0.0
+        self.updated = time.monotonic()
+
+    def _drain(self):
+        now = time.monotonic()
+        self.level = max(0.0, self.level - (now - self.updated) * self.drip_rate)
+        self.updated = now
+
+    def acquire(self, units):
+        """
+        Block until there is room in the bucket for a request, then reserve it.
+        :param units: Units the request costs
+        :return: Seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._drain()
+                if self.level + units <= self.size:
+                    self.level += units
+                    return waited
+                wait = (self.level + units - self.size) / self.drip_rate
+            time.sleep(wait)
+            waited += wait
+
+    def update(self, bucket_level, drip_rate=None):
+        """
+        Sync with the bucket level reported by the API.
+        Keeps the higher of the reported and local level so requests still in flight stay counted.
+        :param bucket_level: X-LS-API-Bucket-Level header value such as "10/60"
+        :param drip_rate: X-LS-API-Drip-Rate header value
+        :return: None
+        """
+        try:
+            used, size = bucket_level.split("/")
+            used = float(used)
+            size = float(size)
+        except (AttributeError, ValueError):
+            return
+
+        with self.lock:
+            self._drain()
+            self.size = size
+            self.level = max(self.level, used)
+            if drip_rate:
+                self.drip_rate = float(drip_rate)
+
+
+class RequestWindow(object):
+    """
+    Client side copy of the Veracross rate limit shared by all worker threads: a number of
+    requests per fixed window, reported as X-Rate-Limit-Remaining and X-Rate-Limit-Reset
+    (seconds until the window resets).
+    """
+
+    def __init__(self, limit=300, reserve=1):
+        """
+        :param limit: Requests per window until the API reports otherwise
+        :param reserve: Requests of each window left unused, as the Veracross client always did
+        """
+        self.lock = threading.Lock()
+        self.limit = limit
+        self.reserve = reserve
+        self.remaining = limit
+        self.reset_at = None
+
+    def acquire(self):
+        """
+        Block until the window has a request left, then reserve it.
+        :return: Seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if self.reset_at is not None and now >= self.reset_at:
+                    self.remaining = self.limit
+                    self.reset_at = None
+                if self.remaining > self.reserve:
+                    self.remaining -= 1
+                    return waited
+                if self.reset_at is None:
+                    wait = 1.0
+                else:
+                    wait = self.reset_at - now
+            time.sleep(wait)
+            waited += wait
+
+    def update(self, remaining, reset):
+        """
+        Sync with the window reported by the API.
+        Within a window keeps the lower of the reported and local count so requests still in flight
+        stay counted. A later reset than expected means a new window, so the reported count is taken.
+        :param remaining: X-Rate-Limit-Remaining header value
+        :param reset: X-Rate-Limit-Reset header value
+        :return: None
+        """
+        try:
+            remaining = int(remaining)
+            reset = float(reset)
+        except (TypeError, ValueError):
+            return
+
+        with self.lock:
+            # A second late, as the Veracross client always waited.
+            reset_at = time.monotonic() + reset + 1
+            if self.reset_at is None or reset_at > self.reset_at + 1:
+                self.remaining = remaining
+            else:
+                self.remaining = min(self.remaining, remaining)
+            self.reset_at = reset_at
+
+
+def run_concurrent(func, items, workers=1):
+    """
+    Run func over items on a bounded thread pool and collect every outcome.
+    :param func: Callable taking one item
+    :param items: Iterable of items
+    :param workers: Number of worker threads
+    :return: list of (item, result, exception) tuples in input order
+    """
+    def call(item):
+        try:
+            return item, func(item), None
+        except Exception as e:
+            return item, None, e
+
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [call(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(call, items))
+
+
+def iter_concurrent(func, items, workers=1, ahead=None):
+    """
+    Run func over items on a bounded thread pool and yield each outcome in input order as soon as
+    it is next, with at most ahead items started but not yet consumed, so results don't pile up.
+    :param func: Callable taking one item
+    :param items: Iterable of items
+    :param workers: Number of worker threads
+    :param ahead: Most items started ahead of the consumer (default twice the workers)
+    :return: Generator of (item, result, exception) tuples in input order
+    """
+    def call(item):
+        try:
+            return item, func(item), None
+        except Exception as e:
+            return item, None, e
+
+    ahead = max(1, ahead or workers * 2)
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        pending = collections.deque()
+        while True:
+            while len(pending) < ahead:
+                item = next(items, END)
+                if item is END:
+                    break
+                pending.append(executor.submit(call, item))
+            if not pending:
+                return
+            yield pending.popleft().result()
+
+
+def run_pipeline(source, stages, queue_size=100):
+    """
+    Stream items from source through stages of worker threads joined by bounded queues.
+    Every stage works at once, and a slow stage holds back the ones before it instead of
+    letting items pile up in memory.
+    :param source: Iterable of items, read on its own thread
+    :param stages: list of (func, workers). func takes an item and returns the item for the next
+                   stage, or None to drop it.
+    :param queue_size: Most items waiting for a stage
+    :return: list of (item, result, exception) tuples of the last stage, in completion order
+    :raises Exception: The first exception raised by the source or a stage before the last, once
+                       the pipeline has stopped
+    """
+    queues = [queue.Queue(queue_size) for stage in stages]
+    results = []
+    errors = []
+    stop = threading.Event()
+
+    def put(n, item):
+        # Stop waiting for room once the pipeline is stopping.
+        while not stop.is_set():
+            try:
+                queues[n].put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def feed():
+        try:
+            for item in source:
+                if stop.is_set():
+                    return
+                put(0, item)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+    def work(n, func):
+        last = n == len(stages) - 1
+        while True:
+            item = queues[n].get()
+            if item is END:
+                return
+            if stop.is_set():
+                continue
+            try:
+                result = func(item)
+            except Exception as e:
+                if last:
+                    results.append((item, None, e))
+                else:
+                    errors.append(e)
+                    stop.set()
+                continue
+            if last:
+                results.append((item, result, None))
+            elif result is not None:
+                put(n + 1, result)
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    groups = []
+    for n, (func, workers) in enumerate(stages):
+        group = [threading.Thread(target=work, args=(n, func), daemon=True) for worker in range(max(1, workers))]
+        for thread in group:
+            thread.start()
+        groups.append(group)
+
+    # Close each stage once the one before it has finished.
+    feeder.join()
+    for n, group in enumerate(groups):
+        for thread in group:
+            queues[n].put(END)
+        for thread in group:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    return results
@@ -0,0 +1,166 @@
+"""
+Long running serve mode: incremental syncs on an interval with warm connections and caches,
+plus a local HTTP endpoint for health checks and metrics.
+"""
+import json
+import logging
+import signal
+import threading
+import time
+
+applogs = logging.getLogger("lsvcconnector")
+
+
+class Server(object):
+    """
+    Runs a callable every interval seconds until stopped, keeping the run context (connections,
+    reference tables and customer indexes) between runs and refreshing its caches on a background
+    thread. GET /health answers with the state of the last run, 503 when it failed, and GET /metrics
+    with everything recorded since the server started in the Prometheus text format.
+    """
+
+    def __init__(self, ctx, run, interval=300, refresh_interval=900, host="127.0.0.1", port=9470):
+        """
+        :param ctx: context.RunContext kept for the life of the server
+        :param run: Callable running one cycle and returning its exit status, 0 on success
+        :param interval: Seconds from the start of one run to the start of the next
+        :param refresh_interval: Seconds between background cache refreshes, 0 for none
+        :param host: Address the HTTP endpoint listens on
+        :param port: Port of the HTTP endpoint, 0 for none
+        """
+        self.ctx = ctx
+        self.run = run
+        self.interval = interval
+        self.refresh_interval = refresh_interval
+        self.host = host
+        self.port = port
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.httpd = None
+        self.started_at = time.time()
+        self.runs = 0
+        self.failures = 0
+        self.last_run = None
+        self.next_run = None
+
+    def __repr__(self):
+        return "Serve mode every {}s".format(self.interval)
+
+    def status(self):
+        """
+        :return: (HTTP status, JSON serialisable health of the server)
+        """
+        with self.lock:
+            health = dict(status="starting",
+                          started_at=self.started_at,
+                          runs=self.runs,
+                          failures=self.failures,
+                          last_run=self.last_run,
+                          next_run=self.next_run)
+        if health["last_run"] is not None:
+            health["status"] = "ok" if health["last_run"]["status"] == 0 else "failing"
+        return (503 if health["status"] == "failing" else 200), health
+
+    def start_http(self):
+        """
+        Listen for /health and /metrics on a daemon thread.
+        :return: None
+        """
+        if not self.port:
+            return
+
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                if path == "/health":
+                    code, health = server.status()
+                    self.reply(code, "application/json", json.dumps(health))
+                elif path == "/metrics":
+                    self.reply(200, "text/plain; version=0.0.4", server.ctx.metrics.prometheus_text())
+                else:
+                    self.reply(404, "text/plain", "Not found\n")
+
+            def reply(self, code, content_type, body):
+                body = body.encode()
+                self.send_response(code)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                applogs.debug("HTTP " + format % args)
+
+        try:
+            self.httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        except OSError as e:
+            applogs.info("Unable to listen on {}:{}: {}".format(self.host, self.port, e))
+            raise SystemExit(2)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        applogs.info("Health and metrics at http://{}:{}/health and /metrics.".format(self.host, self.port))
+
+    def refresh_loop(self):
+        while not self.stopping.wait(self.refresh_interval):
+            started = time.perf_counter()
+            self.ctx.refresh()
+            self.ctx.metrics.add_phase("serve", "refresh", time.perf_counter() - started)
+
+    def run_once(self):
+        """
+        Run one cycle and record its outcome. A cycle that raises counts as failed.
+        :return: exit status of the cycle
+        """
+        started_at = time.time()
+        started = time.perf_counter()
+        try:
+            status = self.run()
+        except (Exception, SystemExit) as e:
+            applogs.info("Serve run failed: {}".format(repr(e)))
+            status = 2
+        seconds = time.perf_counter() - started
+
+        self.ctx.metrics.add_phase("serve", "run", seconds)
+        self.ctx.metrics.record("serve", "runs")
+        if status:
+            self.ctx.metrics.record("serve", "failed")
+        with self.lock:
+            self.runs += 1
+            if status:
+                self.failures += 1
+            self.last_run = dict(started_at=started_at, seconds=round(seconds, 3), status=status)
+        return status
+
+    def stop(self, *args):
+        self.stopping.set()
+
+    def serve_forever(self):
+        """
+        Run until SIGTERM or SIGINT. A run in progress is finished before stopping.
+        :return: exit status of the last run
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.start_http()
+        if self.refresh_interval:
+            threading.Thread(target=self.refresh_loop, daemon=True).start()
+
+        applogs.info("Serving, syncing every {} seconds.".format(self.interval))
+        status = 0
+        while not self.stopping.is_set():
+            started = time.monotonic()
+            status = self.run_once()
+            wait = max(0.0, self.interval - (time.monotonic() - started))
+            with self.lock:
+                self.next_run = time.time() + wait
+            self.stopping.wait(wait)
+
+        applogs.info("Stopping after {} runs.".format(self.runs))
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+        return status
@@ -0,0 +1,284 @@
+"""
+Local SQLite state kept between runs.
+"""
+import datetime
+import os
+import sqlite3
+import threading
+
+DEFAULT_STATE_DIR = os.path.join(os.path.expanduser("~"), ".lsvcconnector")
+DEFAULT_STATE_PATH = os.path.join(DEFAULT_STATE_DIR, "state.db")
+
+default_path_lock = threading.Lock()
+
+
+def default_state_path(account=None):
+    """
+    Default state file of a Lightspeed account, ~/.lsvcconnector/state-ACCOUNT.db.
+    The state.db shared by earlier versions stays with the first account that opens it.
+    :param account: Lightspeed account ID
+    :return: str
+    """
+    if account is None:
+        return DEFAULT_STATE_PATH
+
+    path = os.path.join(DEFAULT_STATE_DIR, "state-{}.db".format(account))
+    with default_path_lock:
+        if not os.path.isfile(path) and os.path.isfile(DEFAULT_STATE_PATH):
+            try:
+                StateDB(DEFAULT_STATE_PATH, account).close()
+                return DEFAULT_STATE_PATH
+            except ValueError:
+                pass
+    return path
+
+
+class StateDB(object):
+    """
+    Small SQLite store for everything the connector remembers between runs.
+    One connection is shared by worker threads, so every statement holds the lock.
+    """
+
+    def __init__(self, path=None, account=None):
+        """
+        :param path: Complete path to the state file. Defaults to default_state_path(account)
+        :param account: Lightspeed account ID. A state file only ever holds the state of one account.
+        :raises ValueError: when the state file belongs to another account
+        """
+        self.path = path or default_state_path(account)
+        if os.path.dirname(self.path) and not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS state_meta ("
+                              "name TEXT PRIMARY KEY, "
+                              "value TEXT NOT NULL)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS sync_marks ("
+                              "sync_key TEXT PRIMARY KEY, "
+                              "synced_at TEXT NOT NULL)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS person_hashes ("
+                              "person_pk TEXT PRIMARY KEY, "
+                              "vc_hash TEXT NOT NULL, "
+                              "customer_id TEXT, "
+                              "synced_at TEXT NOT NULL)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS sync_runs ("
+                              "sync_key TEXT PRIMARY KEY, "
+                              "started_at TEXT NOT NULL, "
+                              "finished_at TEXT, "
+                              "failed INTEGER)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS sync_checkpoints ("
+                              "sync_key TEXT NOT NULL, "
+                              "person_pk TEXT NOT NULL, "
+                              "outcome TEXT NOT NULL, "
+                              "updated_at TEXT NOT NULL, "
+                              "PRIMARY KEY (sync_key, person_pk))")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS exported_lines ("
+                              "export_key TEXT NOT NULL, "
+                              "sale_line_id TEXT NOT NULL, "
+                              "sale_id TEXT NOT NULL, "
+                              "sale_date TEXT NOT NULL, "
+                              "exported_at TEXT NOT NULL, "
+                              "PRIMARY KEY (export_key, sale_line_id))")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS exported_lines_date ON exported_lines "
+                              "(export_key, sale_date)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS balance_clearings ("
+                              "clear_key TEXT PRIMARY KEY, "
+                              "customer_id TEXT NOT NULL, "
+                              "balance TEXT NOT NULL, "
+                              "status TEXT NOT NULL, "
+                              "sale_id TEXT, "
+                              "updated_at TEXT NOT NULL)")
+            # The first account to open the file owns it.
+            if account is not None:
+                self.conn.execute("INSERT OR IGNORE INTO state_meta (name, value) VALUES ('account', ?)",
+                                  (str(account),))
+        row = self.conn.execute("SELECT value FROM state_meta WHERE name = 'account'").fetchone()
+        self.account = row[0] if row else None
+        if account is not None and self.account != str(account):
+            self.conn.close()
+            raise ValueError("State file {} belongs to Lightspeed account {}.".format(self.path, self.account))
+
+    def __repr__(self):
+        return "StateDB at " + self.path
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def get_sync_mark(self, sync_key):
+        """
+        Start time of the last successful sync.
+        :param sync_key: Sync type and filters, see main.sync_key
+        :return: datetime or None
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT synced_at FROM sync_marks WHERE sync_key = ?", (sync_key,)).fetchone()
+        if row:
+            return datetime.datetime.fromisoformat(row[0])
+        return None
+
+    def set_sync_mark(self, sync_key, synced_at):
+        """
+        Record the start time of a successful sync.
+        :param sync_key: Sync type and filters, see main.sync_key
+        :param synced_at: datetime the sync started
+        :return: None
+        """
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO sync_marks (sync_key, synced_at) VALUES (?, ?)",
+                              (sync_key, synced_at.isoformat()))
+
+    def get_person_hashes(self):
+        """
+        Hash of the VC data each person was last synced with.
+        :return: dict of person_pk to hash
+        """
+        with self.lock:
+            rows = self.conn.execute("SELECT person_pk, vc_hash FROM person_hashes").fetchall()
+        return dict(rows)
+
+    def set_person_hashes(self, rows):
+        """
+        Record the VC data hash and Lightspeed customerID of synced people.
+        :param rows: iterable of (person_pk, hash, customerID)
+        :return: None
+        """
+        synced_at = datetime.datetime.now().isoformat()
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO person_hashes "
+                                  "(person_pk, vc_hash, customer_id, synced_at) VALUES (?, ?, ?, ?)",
+                                  [(str(p), h, str(c), synced_at) for p, h, c in rows])
+
+    def start_sync_run(self, sync_key, started_at):
+        """
+        Begin a new sync run, dropping the checkpoints of the last one.
+        :param sync_key: Sync type and filters, see main.sync_key
+        :param started_at: datetime the sync started
+        :return: None
+        """
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO sync_runs (sync_key, started_at, finished_at, failed) "
+                              "VALUES (?, ?, NULL, NULL)", (sync_key, started_at.isoformat()))
+            self.conn.execute("DELETE FROM sync_checkpoints WHERE sync_key = ?", (sync_key,))
+
+    def get_sync_run(self, sync_key):
+        """
+        The last sync run of a sync key.
+        :param sync_key: Sync type and filters, see main.sync_key
+        :return: dict of started_at, finished_at (None if it never finished) and failed, or None
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT started_at, finished_at, failed FROM sync_runs WHERE sync_key = ?",
+                                    (sync_key,)).fetchone()
+        if row is None:
+            return None
+        return dict(started_at=datetime.datetime.fromisoformat(row[0]),
+                    finished_at=datetime.datetime.fromisoformat(row[1]) if row[1] else None,
+                    failed=row[2])
+
+    def finish_sync_run(self, sync_key, failed):
+        """
+        Mark the current sync run finished.
+        :param sync_key: Sync type and filters, see main.sync_key
+        :param failed: Number of records that failed
+        :return: None
+        """
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE sync_runs SET finished_at = ?, failed = ? WHERE sync_key = ?",
+                              (datetime.datetime.now().isoformat(), failed, sync_key))
+
+    def get_checkpoints(self, sync_key):
+        """
+        Outcome of each record processed by the current sync run.
+        :param sync_key: Sync type and filters, see main.sync_key
+        :return: dict of person_pk to outcome
+        """
+        with self.lock:
+            rows = self.conn.execute("SELECT person_pk, outcome FROM sync_checkpoints WHERE sync_key = ?",
+                                     (sync_key,)).fetchall()
+        return dict(rows)
+
+    def set_checkpoints(self, sync_key, rows):
+        """
+        Journal the outcome of processed records.
+        :param sync_key: Sync type and filters, see main.sync_key
+        :param rows: iterable of (person_pk, outcome)
+        :return: None
+        """
+        updated_at = datetime.datetime.now().isoformat()
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO sync_checkpoints "
+                                  "(sync_key, person_pk, outcome, updated_at) VALUES (?, ?, ?, ?)",
+                                  [(sync_key, str(p), o, updated_at) for p, o in rows])
+
+    def get_exported_sales(self, export_key, begin_date, end_date):
+        """
+        Sales already exported between two dates.
+        :param export_key: Shop and customer type of the export
+        :param begin_date: YYYY-MM-DD
+        :param end_date: YYYY-MM-DD
+        :return: set of saleID
+        """
+        with self.lock:
+            rows = self.conn.execute("SELECT DISTINCT sale_id FROM exported_lines "
+                                     "WHERE export_key = ? AND sale_date BETWEEN ? AND ?",
+                                     (export_key, str(begin_date), str(end_date))).fetchall()
+        return set(row[0] for row in rows)
+
+    def add_exported_lines(self, export_key, rows):
+        """
+        Record exported SaleLines.
+        :param export_key: Shop and customer type of the export
+        :param rows: iterable of (saleLineID, saleID, sale date)
+        :return: None
+        """
+        exported_at = datetime.datetime.now().isoformat()
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO exported_lines "
+                                  "(export_key, sale_line_id, sale_id, sale_date, exported_at) "
+                                  "VALUES (?, ?, ?, ?, ?)",
+                                  [(export_key, str(l), str(s), d, exported_at) for l, s, d in rows])
+
+    def get_clearing_status(self, clear_key):
+        """
+        Journal status of a balance clear.
+        :param clear_key: Clearing plan and customer
+        :return: "pending", "cleared", "superseded" or None
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT status FROM balance_clearings WHERE clear_key = ?",
+                                    (clear_key,)).fetchone()
+        if row:
+            return row[0]
+        return None
+
+    def get_pending_clearings(self, customer_id):
+        """
+        Balance clears of a customer left pending by an interrupted run, from any plan.
+        :param customer_id: Lightspeed customerID
+        :return: list of (clear_key, balance)
+        """
+        with self.lock:
+            return self.conn.execute("SELECT clear_key, balance FROM balance_clearings "
+                                     "WHERE customer_id = ? AND status = 'pending'",
+                                     (str(customer_id),)).fetchall()
+
+    def set_clearing(self, clear_key, customer_id, balance, status, sale_id=None):
+        """
+        Journal a balance clear. Committed before returning, so it survives a crash right after.
+        :param clear_key: Clearing plan and customer
+        :param customer_id: Lightspeed customerID
+        :param balance: Balance being cleared
+        :param status: "pending", "cleared" or "superseded"
+        :param sale_id: saleID of the clearing Sale
+        :return: None
+        """
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO balance_clearings "
+                              "(clear_key, customer_id, balance, status, sale_id, updated_at) "
+                              "VALUES (?, ?, ?, ?, ?, ?)",
+                              (clear_key, str(customer_id), str(balance), status, sale_id,
+                               datetime.datetime.now().isoformat()))
@@ -0,0 +1,172 @@
+"""
+Rate limited client for the Veracross API that fetches pages concurrently.
+"""
+import collections
+import logging
+import math
+from concurrent.futures import ThreadPoolExecutor
+from urllib import parse
+
+import ratelimit
+
+applogs = logging.getLogger("lsvcconnector")
+
+# Records per Veracross page.
+PAGE_SIZE = 100
+
+
+class VeracrossError(Exception):
+    """
+    A page of results could not be fetched.
+    """
+    pass
+
+
+class VeracrossClient(object):
+    """
+    Drop in replacement for veracross_api.Veracross.pull, plus iter_pulls to stream records.
+    Reads the first page for X-Total-Count, then fetches the other pages on worker threads that
+    wait on a request window shared by every thread and fed by the rate limit headers, so a pull
+    takes as long as the rate limit allows rather than one request after another.
+    """
+
+    def __init__(self, veracross_connection, window=None, workers=4, metrics=None, timeout=60):
+        """
+        :param veracross_connection: veracross_api.Veracross
+        :param window: Optional ratelimit.RequestWindow shared with other clients
+        :param workers: Pages fetched at once by each pull
+        :param metrics: Optional metrics.Metrics to record rate limit waits in
+        :param timeout: Seconds to wait for Veracross to connect or send data
+        """
+        self.vc = veracross_connection
+        self.window = window or ratelimit.RequestWindow()
+        self.workers = workers
+        self.metrics = metrics
+        self.timeout = timeout
+        self.vc.set_auth()
+
+    def __repr__(self):
+        return "Veracross API Client"
+
+    def url(self, source, parameters=None, page=None):
+        parameters = dict(parameters or {})
+        if page is not None:
+            parameters["page"] = page
+        if parameters:
+            return self.vc.api_url + source + ".json?" + parse.urlencode(parameters, safe=':-')
+        return self.vc.api_url + source + ".json"
+
+    def get(self, url):
+        """
+        Send one GET once the rate limit allows.
+        :param url: Complete API url
+        :return: requests.Response or None on failure
+        """
+        from requests.exceptions import RequestException
+
+        waited = self.window.acquire()
+        if self.metrics is not None:
+            self.metrics.rate_limit_sleep("veracross", waited)
+
+        try:
+            r = self.vc.session.get(url, timeout=self.timeout)
+        except RequestException as e:
+            applogs.info("Veracross GET {} failed: {}".format(url, e))
+            return None
+
+        self.window.update(r.headers.get("X-Rate-Limit-Remaining"), r.headers.get("X-Rate-Limit-Reset"))
+        if r.status_code != 200:
+            applogs.info("Veracross GET {} returned {}.".format(url, r.status_code))
+            return None
+        return r
+
+    def first_page(self, source, parameters=None):
+        """
+        Get the first page of a source.
+        :return: (records, number of pages), pages is None for a single record source
+        :raises VeracrossError: when the page cannot be fetched
+        """
+        r = self.get(self.url(source, parameters))
+        if r is None:
+            raise VeracrossError("Unable to get Veracross " + source)
+        try:
+            if 'X-Total-Count' not in r.headers:
+                return r.json(), None
+            return r.json(), math.ceil(int(r.headers['X-Total-Count']) / PAGE_SIZE)
+        except ValueError:
+            raise VeracrossError("Unreadable Veracross response for " + source)
+
+    def page(self, source, parameters, page):
+        """
+        Get one page of a source.
+        :return: list of records
+        :raises VeracrossError: when the page cannot be fetched
+        """
+        r = self.get(self.url(source, parameters, page))
+        if r is None:
+            raise VeracrossError("Unable to get page {} of Veracross {}".format(page, source))
+        try:
+            return r.json()
+        except ValueError:
+            raise VeracrossError("Unreadable page {} of Veracross {}".format(page, source))
+
+    def pull(self, source, parameters=None):
+        """
+        Get Veracross Data with pagination
+        :param source: VC Source (households, facstaff, facstaff/99)
+        :param parameters: Optional API parameters normally in GET request
+        :return: records in a list of dictionaries, or the record of a single record source. None on failure.
+        """
+        try:
+            records, pages = self.first_page(source, parameters)
+            if pages is None:
+                return records
+            return records + list(self.iter_pages([(source, parameters, pages)]))
+        except VeracrossError as e:
+            applogs.info(str(e))
+            return None
+
+    def iter_pulls(self, pulls):
+        """
+        Stream the records of several paginated pulls as their pages arrive, e.g. one pull per
+        grade level or students alongside faculty. The first pages are fetched at once, then the
+        rest with at most two pages per worker fetched ahead of the consumer.
+        :param pulls: list of (source, parameters)
+        :return: Generator of records, pull by pull in page order
+        :raises VeracrossError: when a page cannot be fetched
+        """
+        first = []
+        for pull, result, error in ratelimit.run_concurrent(lambda pull: self.first_page(pull[0], pull[1]),
+                                                            pulls, len(pulls)):
+            if error is not None:
+                raise error
+            first.append(result)
+
+        for records, pages in first:
+            for record in records:
+                yield record
+        for record in self.iter_pages([(source, parameters, pages or 1)
+                                       for (source, parameters), (records, pages) in zip(pulls, first)]):
+            yield record
+
+    def iter_pages(self, pulls):
+        """
+        Stream the records of pages 2 onwards of each pull, fetched on worker threads in order.
+        :param pulls: list of (source, parameters, number of pages)
+        :return: Generator of records
+        :raises VeracrossError: when a page cannot be fetched
+        """
+        pages = iter([(source, parameters, page) for source, parameters, count in pulls
+                      for page in range(2, count + 1)])
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = collections.deque()
+            while True:
+                while len(pending) < self.workers * 2:
+                    task = next(pages, None)
+                    if task is None:
+                        break
+                    pending.append(executor.submit(self.page, *task))
+                if not pending:
+                    return
+                for record in pending.popleft().result():
+                    yield record
@@ -0,0 +1,221 @@
+"""
+Export file writers besides CSV: Parquet and Arrow IPC through the optional pyarrow package,
+and XLSX with the standard library.
+"""
+import datetime
+import os
+import re
+import zipfile
+from decimal import Decimal, ROUND_HALF_UP
+from xml.sax.saxutils import escape
+
+# export_columnar option to file extension.
+COLUMNAR_FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+
+# Column types of each export. Decimals are (precision, scale).
+# The export_options_* columns are Veracross codes given as is in the operation JSON.
+SALELINE_TYPES = dict(person_id="string",
+                      customer_account_number="string",
+                      customer_name="string",
+                      transaction_source="string",
+                      transaction_type="string",
+                      school_year="string",
+                      item_date="date",
+                      catalog_item_fk="string",
+                      description="string",
+                      quantity="int",
+                      unit_price=(19, 5),
+                      purchase_amount=(19, 5),
+                      tax_amount=(19, 2),
+                      total_amount=(19, 2),
+                      pos_transaction_id="int")
+
+BALANCE_TYPES = dict(first_name="string",
+                     last_name="string",
+                     veracross_id="string",
+                     lightspeed_cust_type="int",
+                     balance=(19, 2),
+                     lightspeed_cust_num="int")
+
+# Characters XML 1.0 does not allow, even escaped.
+XML_ILLEGAL = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+def pyarrow_available():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def converter(column_type):
+    """
+    Function converting an export value to its column type. Empty values become None.
+    Decimals are rounded half up to the column scale.
+    :param column_type: "string", "int", "date" or (precision, scale)
+    :return: callable
+    """
+    if column_type == "string":
+        return lambda v: None if v is None else str(v)
+    if column_type == "int":
+        return lambda v: None if v is None or v == '' else int(v)
+    if column_type == "date":
+        return lambda v: datetime.date.fromisoformat(str(v)[:10]) if v else None
+
+    exponent = Decimal(1).scaleb(-column_type[1])
+    return lambda v: None if v is None or v == '' else Decimal(v).quantize(exponent, rounding=ROUND_HALF_UP)
+
+
+class ColumnarWriter(object):
+    """
+    Writes export rows in batches to a Parquet or Arrow IPC file, with decimal columns for amounts.
+    The file is written under a partial name and only takes its real name on close.
+    """
+
+    def __init__(self, filename, export_format, header, types):
+        """
+        :param filename: Complete path of the file
+        :param export_format: "parquet" or "arrow"
+        :param header: Column names in row order
+        :param types: dict of column name to column type, see converter()
+        """
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+
+        self.pa = pyarrow
+        self.filename = filename
+        self.converters = [converter(types[name]) for name in header]
+        self.schema = pyarrow.schema([(name, self.arrow_type(types[name])) for name in header])
+        self.sink = None
+        if export_format == "parquet":
+            self.writer = pyarrow.parquet.ParquetWriter(filename + ".part", self.schema)
+        else:
+            self.sink = pyarrow.OSFile(filename + ".part", "wb")
+            self.writer = pyarrow.ipc.new_file(self.sink, self.schema)
+
+    def __repr__(self):
+        return "Columnar export to " + self.filename
+
+    def arrow_type(self, column_type):
+        if column_type == "string":
+            return self.pa.string()
+        if column_type == "int":
+            return self.pa.int64()
+        if column_type == "date":
+            return self.pa.date32()
+        return self.pa.decimal128(*column_type)
+
+    def write_rows(self, rows):
+        """
+        Write one batch of rows.
+        :param rows: list of rows in header order
+        :return: None
+        """
+        if not rows:
+            return
+        arrays = [self.pa.array([convert(v) for v in column], type=field.type)
+                  for column, convert, field in zip(zip(*rows), self.converters, self.schema)]
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+        if self.sink is not None:
+            self.sink.close()
+        os.replace(self.filename + ".part", self.filename)
+
+    def abort(self):
+        """
+        Stop writing after a failure and remove the partial file.
+        :return: None
+        """
+        try:
+            self.writer.close()
+            if self.sink is not None:
+                self.sink.close()
+        except Exception:
+            pass
+        if os.path.exists(self.filename + ".part"):
+            os.remove(self.filename + ".part")
+
+
+def xlsx_cell(ref, value):
+    if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+        return '<c r="{}"><v>{}</v></c>'.format(ref, value)
+    text = escape(XML_ILLEGAL.sub("", "" if value is None else str(value)))
+    return '<c r="{}" t="inlineStr"><is><t xml:space="preserve">{}</t></is></c>'.format(ref, text)
+
+
+def column_letter(n):
+    letters = ""
+    n += 1
+    while n:
+        n, remainder = divmod(n - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+def typed(convert, value):
+    # Keep values that don't convert as they are. A workbook cell can hold anything.
+    try:
+        return convert(value)
+    except (TypeError, ValueError, ArithmeticError):
+        return value
+
+
+def write_xlsx(filename, rows, types=None, sheet_name="Sheet1"):
+    """
+    Write rows to a single sheet XLSX workbook.
+    :param filename: Complete path of the workbook
+    :param rows: list of rows, the first being the header
+    :param types: Optional dict of column name to column type, so numbers are written as numbers
+    :param sheet_name: Name of the sheet
+    :return: None
+    """
+    converters = None
+    if types and rows:
+        converters = [converter(types.get(name, "string")) for name in rows[0]]
+
+    sheet = ['<?xml version="1.0" encoding="UTF-8" standalone="yes"?>',
+             '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>']
+    for r, row in enumerate(rows):
+        if converters and r > 0:
+            row = [typed(convert, v) for convert, v in zip(converters, row)]
+        sheet.append('<row r="{}">'.format(r + 1))
+        sheet.extend(xlsx_cell(column_letter(c) + str(r + 1), value) for c, value in enumerate(row))
+        sheet.append('</row>')
+    sheet.append('</sheetData></worksheet>')
+
+    with zipfile.ZipFile(filename + ".part", "w", zipfile.ZIP_DEFLATED) as workbook:
+        workbook.writestr("[Content_Types].xml",
+                          '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                          '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                          '<Default Extension="rels" '
+                          'ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                          '<Default Extension="xml" ContentType="application/xml"/>'
+                          '<Override PartName="/xl/workbook.xml" '
+                          'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+                          '<Override PartName="/xl/worksheets/sheet1.xml" '
+                          'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+                          '</Types>')
+        workbook.writestr("_rels/.rels",
+                          '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                          '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                          '<Relationship Id="rId1" '
+                          'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+                          'Target="xl/workbook.xml"/></Relationships>')
+        workbook.writestr("xl/workbook.xml",
+                          '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                          '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+                          'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+                          '<sheets><sheet name="{}" sheetId="1" r:id="rId1"/></sheets></workbook>'.format(
+                              escape(sheet_name, {'"': "&quot;"})))
+        workbook.writestr("xl/_rels/workbook.xml.rels",
+                          '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                          '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                          '<Relationship Id="rId1" '
+                          'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+                          'Target="worksheets/sheet1.xml"/></Relationships>')
+        workbook.writestr("xl/worksheets/sheet1.xml", "".join(sheet))
+    os.replace(filename + ".part", filename)